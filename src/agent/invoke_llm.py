@@ -1,12 +1,17 @@
+import asyncio
 import os
 import re
-import shutil
+import threading
+from typing import Coroutine, List
 
+import httpx
 from langchain.agents import AgentExecutor, create_tool_calling_agent
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.callbacks import FileCallbackHandler
+from langchain_core.callbacks import BaseCallbackHandler, FileCallbackHandler
+from langchain_core.outputs import LLMResult
 from langchain_openai import ChatOpenAI, AzureChatOpenAI
 
+from agent.llm_cache import CachedChatModel, ResponseCache
 from agent.prompt import (
     SYSTEM_PROMPT,
     SYSTEM_PROMPT_PTACH,
@@ -15,13 +20,58 @@ from agent.prompt import (
 )
 from tools.logger import logger
 from tools.project import Project
-from tools.utils import split_patch
+from tools.utils import group_dependent_hunks, split_patch, timed
 
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+_loop = None
 
-def initial_agent(project: Project, data, debug_mode: bool):
-    use_azure = data.use_azure
 
-    if use_azure:
+def _get_http_clients(data) -> tuple[httpx.Client, httpx.AsyncClient]:
+    """
+    Get the keep-alive HTTP clients shared by every LLM of the process talking to the
+    same endpoint. At most `llm_concurrency` requests are in flight, others wait for a
+    free connection.
+    """
+    key = (data.llm_base_url, data.azure_endpoint, data.llm_concurrency)
+    with _http_clients_lock:
+        if key not in _http_clients:
+            limits = httpx.Limits(
+                max_connections=data.llm_concurrency,
+                max_keepalive_connections=data.llm_concurrency,
+            )
+            # LLM responses take long, waiting for a free connection must not time out
+            timeout = httpx.Timeout(600, pool=None)
+            _http_clients[key] = (
+                httpx.Client(limits=limits, timeout=timeout),
+                httpx.AsyncClient(limits=limits, timeout=timeout),
+            )
+        return _http_clients[key]
+
+
+def run_async(coro: Coroutine):
+    """
+    Run a coroutine on the event loop of the process and wait for its result.
+
+    The loop lives in a background thread for the whole process, so the pooled async
+    HTTP connections stay usable across jobs.
+    """
+    global _loop
+    with _http_clients_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True).start()
+    future = asyncio.run_coroutine_threadsafe(coro, _loop)
+    try:
+        return future.result()
+    except KeyboardInterrupt:
+        future.cancel()
+        raise
+
+
+def create_llm(data) -> ChatOpenAI:
+    http_client, http_async_client = _get_http_clients(data)
+    if data.use_azure:
         azure_endpoint = data.azure_endpoint
         azure_deployment = data.azure_deployment
         azure_api_version = data.azure_api_version
@@ -35,20 +85,41 @@ def initial_agent(project: Project, data, debug_mode: bool):
             api_key=api_key,
             azure_endpoint=azure_endpoint,
             api_version=azure_api_version,
+            http_client=http_client,
+            http_async_client=http_async_client,
+            # agents stream their calls, ask for the token usage in the last chunk
+            model_kwargs={"stream_options": {"include_usage": True}},
             verbose=True,
         )
     else:
-        # Regular OpenAI configuration
-        logger.info("Using OpenAI API")
-        base_url = "https://api.openai.com/v1"
+        # OpenAI or any OpenAI-compatible server, e.g. vLLM or llama.cpp
+        logger.info(f"Using {data.llm_model} at {data.llm_base_url}")
         llm = ChatOpenAI(
-            temperature=0.5,
-            model="gpt-4-turbo",
-            api_key=data.openai_key,
-            openai_api_base=base_url,
+            temperature=data.llm_temperature,
+            model=data.llm_model,
+            # local servers usually ignore the key, but the client requires one
+            api_key=data.openai_key or "EMPTY",
+            openai_api_base=data.llm_base_url,
+            http_client=http_client,
+            http_async_client=http_async_client,
+            # agents stream their calls, ask for the token usage in the last chunk
+            model_kwargs={"stream_options": {"include_usage": True}},
             verbose=True,
         )
 
+    if data.llm_cache != "off":
+        logger.info(f"LLM response cache in {data.llm_cache} mode")
+        llm = CachedChatModel(
+            llm=llm,
+            response_cache=ResponseCache(
+                os.path.join(data.cache_dir, "llm"), data.llm_cache_mb * 1024 * 1024
+            ),
+            mode=data.llm_cache,
+        )
+    return llm
+
+
+def create_hunk_agent(project: Project, llm: ChatOpenAI, debug_mode: bool):
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system", SYSTEM_PROMPT),
@@ -62,57 +133,181 @@ def initial_agent(project: Project, data, debug_mode: bool):
     agent_executor = AgentExecutor(
         agent=agent, tools=tools, verbose=debug_mode, max_iterations=30
     )
-    return agent_executor, llm
+    return agent_executor
 
 
-def do_backport(
-    agent_executor: AgentExecutor, project: Project, data, llm: ChatOpenAI, logfile: str
-):
-    log_handler = FileCallbackHandler(logfile)
+class TokenUsageHandler(BaseCallbackHandler):
+    """
+    Count the tokens reported by the LLM across every agent session of a job.
+    """
 
-    patch = project._get_patch(data.new_patch)
-    pps = split_patch(patch, True)
+    def __init__(self):
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.lock = threading.Lock()
+
+    def on_llm_end(self, response: LLMResult, **kwargs) -> None:
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        if not usage:
+            # streamed responses carry the usage on the message instead
+            for generations in response.generations:
+                for generation in generations:
+                    metadata = getattr(generation, "message", None)
+                    metadata = getattr(metadata, "usage_metadata", None) or {}
+                    prompt_tokens += metadata.get("input_tokens", 0)
+                    completion_tokens += metadata.get("output_tokens", 0)
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def as_dict(self) -> dict:
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.prompt_tokens + self.completion_tokens,
+        }
+
+
+async def _backport_hunks(
+    project: Project,
+    data,
+    llm: ChatOpenAI,
+    pps: List[str],
+    callbacks: list,
+    debug_mode: bool,
+) -> List[List[str]] | None:
+    """
+    Backport every hunk, running the agent sessions of independent hunks concurrently.
+
+    Each hunk gets its own fork of the project. Hunks touching overlapping regions of a
+    file are handed to the agent one after another, at most `hunk_workers` groups are
+    in progress at a time.
+
+    Returns:
+        List[List[str]] | None: The succeeded patches of each hunk in the original order,
+            or None if a hunk could not be backported.
+    """
+    # git history of every hunk is computed in the background meanwhile
+    project.prefetch_history(pps)
+    results = [None] * len(pps)
+    conflicts = {}
     for idx, pp in enumerate(pps):
-        project.round_succeeded = False
-        project.context_mismatch_times = 0
-        ret = project._apply_hunk(data.target_release, pp, False)
-        if project.round_succeeded:
+        hunk_project = project.fork()
+        ret = hunk_project._apply_hunk(data.target_release, pp, False)
+        if hunk_project.round_succeeded:
             logger.debug(f"Hunk {idx} can be applied without any conflicts")
-            continue
+            results[idx] = hunk_project.succeeded_patches
         else:
             block_list = re.findall(r"older version.\n(.*?)\nBesides,", ret, re.DOTALL)
-            similar_block = "\n".join(block_list)
-            logger.debug(f"Hunk {idx} can not be applied, using LLM to generate a fix")
-            project.now_hunk = pp
-            project.now_hunk_num = idx
-            agent_executor.invoke(
-                {
-                    "project_url": data.project_url,
-                    "new_patch_parent": data.new_patch_parent,
-                    "new_patch": pp,
-                    "target_release": data.target_release,
-                    "similar_block": similar_block,
-                },
-                {"callbacks": [log_handler]},
+            conflicts[idx] = (hunk_project, "\n".join(block_list))
+
+    failed = asyncio.Event()
+    workers = asyncio.Semaphore(data.hunk_workers)
+
+    async def backport_group(group: List[int]) -> None:
+        async with workers:
+            for idx in group:
+                await backport_hunk(idx)
+
+    async def backport_hunk(idx: int) -> None:
+        hunk_project, similar_block = conflicts[idx]
+        logger.debug(f"Hunk {idx} can not be applied, using LLM to generate a fix")
+        hunk_project.now_hunk = pps[idx]
+        hunk_project.now_hunk_num = idx
+        await create_hunk_agent(hunk_project, llm, debug_mode).ainvoke(
+            {
+                "project_url": data.project_url,
+                "new_patch_parent": data.new_patch_parent,
+                "new_patch": pps[idx],
+                "target_release": data.target_release,
+                "similar_block": similar_block,
+            },
+            {"callbacks": callbacks},
+        )
+        if not hunk_project.round_succeeded:
+            logger.debug(
+                f"Failed to backport the hunk {idx} \n----------------------------------\n{pps[idx]}\n----------------------------------\n"
             )
-            if not project.round_succeeded:
-                logger.debug(
-                    f"Failed to backport the hunk {idx} \n----------------------------------\n{pp}\n----------------------------------\n"
-                )
-                logger.error(f"Reach max_iterations for hunk {idx}")
-                return
+            logger.error(f"Reach max_iterations for hunk {idx}")
+            failed.set()
+            # the job is lost, stop the sessions of the other hunks spending LLM calls
+            for task in tasks:
+                if task is not asyncio.current_task():
+                    task.cancel()
+            return
+        results[idx] = hunk_project.succeeded_patches
+
+    groups = [
+        [idx for idx in group if idx in conflicts]
+        for group in group_dependent_hunks(pps)
+    ]
+    groups = [group for group in groups if group]
+    if groups:
+        logger.debug(
+            f"{len(conflicts)} hunks in {len(groups)} independent groups need the LLM"
+        )
+    tasks = [asyncio.create_task(backport_group(group)) for group in groups]
+    try:
+        await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        if not failed.is_set():
+            raise
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    for hunk_project, _ in conflicts.values():
+        for stage, seconds in hunk_project.stage_times.items():
+            project.stage_times[stage] = project.stage_times.get(stage, 0) + seconds
+
+    return None if failed.is_set() else results
+
+
+def do_backport(
+    project: Project,
+    data,
+    llm: ChatOpenAI,
+    logfile: str,
+    debug_mode: bool,
+    callbacks: list | None = None,
+):
+    run_async(
+        ado_backport(project, data, llm, logfile, debug_mode, callbacks=callbacks)
+    )
+
+
+async def ado_backport(
+    project: Project,
+    data,
+    llm: ChatOpenAI,
+    logfile: str,
+    debug_mode: bool,
+    callbacks: list | None = None,
+):
+    log_handler = FileCallbackHandler(logfile)
+    callbacks = [log_handler] + (callbacks or [])
+
+    patch = project._get_patch(data.new_patch)
+    pps = list(split_patch(patch, True))
+    with timed(project.stage_times, "hunks"):
+        hunk_patches = await _backport_hunks(
+            project, data, llm, pps, callbacks, debug_mode
+        )
+    if hunk_patches is None:
+        return
+    project.succeeded_patches = [pp for patches in hunk_patches for pp in patches]
 
     project.all_hunks_applied_succeeded = True
     logger.info(f"Aplly all hunks in the patch      PASS")
     project.now_hunk = "completed"
     complete_patch = "\n".join(project.succeeded_patches)
-    project.repo.git.clean("-fdx")
-    for file in os.listdir(data.patch_dataset_dir):
-        if os.path.exists(f"{data.project_dir}{file}"):
-            os.remove(f"{data.project_dir}{file}")
-        shutil.copy2(f"{data.patch_dataset_dir}{file}", f"{data.project_dir}{file}")
     project.context_mismatch_times = 0
-    validate_ret = project._validate(data.target_release, complete_patch)
+    # build, testcase and PoC block for minutes, keep them off the event loop
+    validate_ret = await asyncio.to_thread(
+        project._validate, data.target_release, complete_patch
+    )
     if project.poc_succeeded:
         logger.info(
             f"Successfully backport the patch to the target release {data.target_release}"
@@ -135,17 +330,18 @@ def do_backport(
     agent_executor = AgentExecutor(
         agent=agent, tools=tools, verbose=True, max_iterations=20
     )
-    agent_executor.invoke(
-        {
-            "project_url": data.project_url,
-            "new_patch_parent": data.new_patch_parent,
-            "target_release": data.target_release,
-            "new_patch": patch,
-            "complete_patch": complete_patch,
-            "compile_ret": validate_ret,
-        },
-        {"callbacks": [log_handler]},
-    )
+    with timed(project.stage_times, "patch_agent"):
+        await agent_executor.ainvoke(
+            {
+                "project_url": data.project_url,
+                "new_patch_parent": data.new_patch_parent,
+                "target_release": data.target_release,
+                "new_patch": patch,
+                "complete_patch": complete_patch,
+                "compile_ret": validate_ret,
+            },
+            {"callbacks": callbacks},
+        )
     if project.poc_succeeded:
         logger.info(
             f"Successfully backport the patch to the target release {data.target_release}"
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Iterator, List, Optional
+
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import (
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from tools.logger import logger
+
+CACHE_MODES = ("off", "read-through", "replay-only")
+
+
+class LLMCacheMiss(Exception):
+    """
+    Raised in replay-only mode when a request has no cached response.
+    """
+
+
+class ResponseCache:
+    """
+    LLM responses stored as one JSON file per request hash.
+
+    Reading a response refreshes its mtime, so once the cache grows beyond `max_bytes`
+    the least recently used responses are removed first.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _entries(self) -> Iterator[tuple[float, str, int]]:
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, entry.path, stat.st_size
+
+    def get(self, key: str) -> dict | None:
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: dict) -> None:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, concurrent readers only ever see complete files
+        with tempfile.NamedTemporaryFile(
+            mode="w", dir=os.path.dirname(path), delete=False
+        ) as f:
+            json.dump(value, f)
+        size = os.path.getsize(f.name)
+        os.replace(f.name, path)
+        with self.lock:
+            self.size += size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        # other processes share the directory, recount before removing anything
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, path, size in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def stats(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses, "
+            f"{self.size / 1024 / 1024:.1f}/{self.max_bytes / 1024 / 1024:.0f} MB"
+        )
+
+
+class CachedChatModel(BaseChatModel):
+    """
+    Chat model answering from a `ResponseCache` before calling the wrapped model.
+
+    Requests are keyed by a hash of the model, temperature, messages and tools. In
+    read-through mode a miss calls the wrapped model and stores its response, in
+    replay-only mode a miss raises `LLMCacheMiss`. Responses served from the cache
+    report no token usage.
+    """
+
+    llm: BaseChatModel
+    response_cache: ResponseCache
+    mode: str = "read-through"
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cached-{self.llm._llm_type}"
+
+    def bind_tools(self, tools, **kwargs):
+        # let the wrapped model format the tools, then bind them to the wrapper
+        return self.bind(**self.llm.bind_tools(tools, **kwargs).kwargs)
+
+    def _key(
+        self, messages: List[BaseMessage], stop: Optional[List[str]], **kwargs: Any
+    ) -> str:
+        request = {
+            "model": getattr(self.llm, "deployment_name", None)
+            or getattr(self.llm, "model_name", self.llm._llm_type),
+            "temperature": getattr(self.llm, "temperature", None),
+            "messages": [],
+            "stop": stop,
+            "kwargs": kwargs,
+        }
+        for message in messages:
+            message = message_to_dict(message)
+            # ids and metadata of earlier responses differ between runs
+            for field in ("id", "response_metadata", "usage_metadata"):
+                message["data"].pop(field, None)
+            request["messages"].append(message)
+        return hashlib.sha256(
+            json.dumps(request, sort_keys=True, default=str).encode()
+        ).hexdigest()
+
+    def _lookup(self, key: str) -> ChatResult | None:
+        value = self.response_cache.get(key)
+        if value is not None:
+            logger.debug(f"LLM response {key[:12]} served from cache.")
+            message = messages_from_dict([value["message"]])[0]
+            message.usage_metadata = None
+            return ChatResult(generations=[ChatGeneration(message=message)])
+        if self.mode == "replay-only":
+            raise LLMCacheMiss(f"No cached LLM response for request {key}")
+        return None
+
+    def _store(self, key: str, result: ChatResult) -> ChatResult:
+        self.response_cache.put(
+            key, {"message": message_to_dict(result.generations[0].message)}
+        )
+        return result
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key(messages, stop, **kwargs)
+        if result := self._lookup(key):
+            return result
+        return self._store(
+            key, generate_from_stream(self.llm._stream(messages, stop=stop, **kwargs))
+        )
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key(messages, stop, **kwargs)
+        if result := self._lookup(key):
+            return result
+        return self._store(
+            key,
+            await agenerate_from_stream(
+                self.llm._astream(messages, stop=stop, **kwargs)
+            ),
+        )
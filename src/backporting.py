@@ -1,19 +1,29 @@
 import argparse
 import datetime
+import json
 import logging
 import os
 import shutil
 import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 from types import SimpleNamespace
 
 import git
 import yaml
 
-from agent.invoke_llm import do_backport, initial_agent
+from agent.invoke_llm import TokenUsageHandler, create_llm, do_backport
+from agent.llm_cache import CACHE_MODES, CachedChatModel
 from check.usage import get_usage
+from tools.builder import BuildTimeout, remove_stale_containers
+from tools.cache import lines_cache
 from tools.logger import add_file_handler, logger
 from tools.project import Project
 
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+
 
 def is_commit_valid(commit_id: str, project_dir: str):
     try:
@@ -54,6 +64,40 @@ def load_yml(file_path: str):
     data.patch_dataset_dir = config.get("patch_dataset_dir")
     data.openai_key = config.get("openai_key")
     data.tag = config.get("tag")
+    data.cache_dir = os.path.expanduser(
+        config.get("cache_dir", "~/.cache/patch-backporting")
+    )
+    data.lines_cache_mb = config.get("lines_cache_mb", 256)
+    data.blob_cache_mb = config.get("blob_cache_mb", 2048)
+    data.max_worktrees = config.get("max_worktrees", 4)
+    data.hunk_workers = config.get("hunk_workers", 4)
+    data.validation_cache = config.get("validation_cache", True)
+    data.build_mode = config.get("build_mode", "docker")
+    data.build_image = config.get("build_image", "build-kernel-ubuntu-16.04")
+    data.ccache_dir = os.path.expanduser(
+        config.get("ccache_dir", os.path.join(data.cache_dir, "ccache"))
+    )
+    data.max_build_errors = config.get("max_build_errors", 10)
+    data.prebuild = config.get("prebuild", False)
+    data.prebuild_make_args = config.get("prebuild_make_args")
+    data.syntax_check = config.get("syntax_check", True)
+    data.feedback_tokens = config.get("feedback_tokens", 2000)
+    data.log_dir = os.path.expanduser(config.get("log_dir", "../logs"))
+    if data.build_mode not in ("docker", "local"):
+        logger.error("build_mode must be docker or local.\n")
+        exit(1)
+
+    # OpenAI-compatible endpoint, e.g. a local vLLM or llama.cpp server
+    data.llm_base_url = config.get("llm_base_url", OPENAI_BASE_URL)
+    data.llm_model = config.get("llm_model", "gpt-4-turbo")
+    data.llm_temperature = config.get("llm_temperature", 0.5)
+    data.llm_concurrency = config.get("llm_concurrency", 8)
+    # YAML reads a bare `off` as False
+    data.llm_cache = config.get("llm_cache") or "off"
+    data.llm_cache_mb = config.get("llm_cache_mb", 1024)
+    if data.llm_cache not in CACHE_MODES:
+        logger.error(f"llm_cache must be one of {', '.join(CACHE_MODES)}.\n")
+        exit(1)
 
     # Azure OpenAI configuration (optional)
     data.use_azure = config.get("use_azure", False)
@@ -119,69 +163,261 @@ def load_yml(file_path: str):
     return data
 
 
-def main():
-    # process arguments
-    parser = argparse.ArgumentParser(
-        description="Backports patch with the help of LLM",
-        usage="%(prog)s --config CONFIG.yml\ne.g.: python %(prog)s --config CVE-examaple.yml",
+def log_cost(data, before_usage, start_time: float):
+    end_time = time.time()
+    after_usage = get_usage(data.openai_key)
+    logger.debug(
+        f"This patch total cost: ${(after_usage['total_cost'] - before_usage['total_cost']):.2f}"
     )
-    parser.add_argument(
-        "-c", "--config", type=str, required=True, help="CVE config yml"
+    logger.debug(
+        f"This patch total consume tokens: {(after_usage['total_consume_tokens'] - before_usage['total_consume_tokens'])/1000}(k)"
     )
-    parser.add_argument("-d", "--debug", action="store_true", help="enable debug mode")
-    args = parser.parse_args()
-    debug_mode = args.debug
-    config_file = args.config
-    if debug_mode:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
+    logger.debug(f"This patch total cost time: {int(end_time - start_time)} Seconds.")
+
 
+def log_tokens(token_usage: TokenUsageHandler, start_time: float):
+    logger.debug(
+        f"This patch total consume tokens: {token_usage.as_dict()['total_tokens']/1000}(k)"
+    )
+    logger.debug(
+        f"This patch total cost time: {int(time.time() - start_time)} Seconds."
+    )
+
+
+def run_job(config_file: str, debug_mode: bool, report_cost: bool = True) -> dict:
+    """
+    Backport the patch described by one CVE config.
+
+    Args:
+        config_file (str): The path to the CVE config yml.
+        debug_mode (bool): Enable debug mode.
+        report_cost (bool): Query the API billing before and after the job. It is not
+            meaningful when several jobs share one key concurrently, and only done for an
+            OpenAI key used against api.openai.com.
+
+    Returns:
+        dict: The job record, with its status (succeeded, failed, timeout, interrupted),
+            wall time per stage, token use and log file.
+
+    Raises:
+        Exception: Whatever made the job fail, with the job record, its status set to
+            error, as its `record` attribute.
+    """
     # load and check config, create file log
     data = load_yml(config_file)
-    log_dir = "../logs"
-    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(data.log_dir, exist_ok=True)
     now = datetime.datetime.now().strftime("%m%d%H%M")
-    logfile = os.path.join(log_dir, f"{data.project}-{data.tag}-{now}.log")
-    add_file_handler(logger, logfile)
+    logfile = os.path.join(data.log_dir, f"{data.project}-{data.tag}-{now}.log")
+    file_handler = add_file_handler(logger, logfile)
+    record = {
+        "config": config_file,
+        "project": data.project,
+        "tag": data.tag,
+        "status": "failed",
+        "log": os.path.abspath(logfile),
+    }
 
-    # use LLM to backport
+    # the billing API only knows about OpenAI keys, other endpoints report token counts
+    report_cost = (
+        report_cost
+        and bool(data.openai_key)
+        and not data.use_azure
+        and data.llm_base_url.rstrip("/") == OPENAI_BASE_URL
+    )
 
+    # use LLM to backport
     project = Project(data)
     project.repo.git.clean("-fdx")
     start_time = time.time()
-    before_usage = get_usage(data.openai_key)
-    agent_executor, llm = initial_agent(project, data, debug_mode)
+    if report_cost:
+        before_usage = get_usage(data.openai_key)
+    token_usage = TokenUsageHandler()
+    llm = create_llm(data)
     try:
-        do_backport(agent_executor, project, data, llm, logfile)
-        end_time = time.time()
-        time.sleep(10)
-        after_usage = get_usage(data.openai_key)
-        logger.debug(
-            f"This patch total cost: ${(after_usage['total_cost'] - before_usage['total_cost']):.2f}"
-        )
-        logger.debug(
-            f"This patch total consume tokens: {(after_usage['total_consume_tokens'] - before_usage['total_consume_tokens'])/1000}(k)"
-        )
-        logger.debug(
-            f"This patch total cost time: {int(end_time - start_time)} Seconds."
-        )
+        do_backport(project, data, llm, logfile, debug_mode, callbacks=[token_usage])
+        if project.poc_succeeded:
+            record["status"] = "succeeded"
+        logger.debug(f"Lines cache: {lines_cache.stats()}")
+        if isinstance(llm, CachedChatModel):
+            logger.debug(f"LLM cache: {llm.response_cache.stats()}")
+        if report_cost:
+            time.sleep(10)
+            log_cost(data, before_usage, start_time)
+    except BuildTimeout:
+        record["status"] = "timeout"
     except KeyboardInterrupt:
-        logger.debug("Start to calculate cost!")
-        end_time = time.time()
+        record["status"] = "interrupted"
+        if report_cost:
+            logger.debug("Start to calculate cost!")
+            log_cost(data, before_usage, start_time)
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = traceback.format_exc()
+        # filled in below, the batch runner reports it instead of a bare error
+        e.record = record
+        raise
+    finally:
+        record["stage_times"] = {
+            stage: round(seconds, 2) for stage, seconds in project.stage_times.items()
+        }
+        record["total_time"] = round(time.time() - start_time, 2)
+        record["tokens"] = token_usage.as_dict()
+        if not report_cost:
+            log_tokens(token_usage, start_time)
+        project.close()
+        shutil.copy(logfile, data.patch_dataset_dir)
+        logger.removeHandler(file_handler)
+        file_handler.close()
 
-        after_usage = get_usage(data.openai_key)
-        logger.debug(
-            f"This patch total cost: ${(after_usage['total_cost'] - before_usage['total_cost']):.2f}"
-        )
-        logger.debug(
-            f"This patch total consume tokens: {(after_usage['total_consume_tokens'] - before_usage['total_consume_tokens'])/1000}(k)"
+    return record
+
+
+def _run_batch_job(config_file: str, debug_mode: bool) -> dict:
+    # runs in a worker process, a failing job must never take the batch down
+    logger.setLevel(logging.DEBUG if debug_mode else logging.INFO)
+    start_time = time.time()
+    try:
+        return run_job(config_file, debug_mode, report_cost=False)
+    except BaseException as e:
+        # load_yml exits on invalid configs
+        logger.error(f"Job {config_file} failed: {e!r}")
+        # jobs failing once started keep their stage times, token use and log
+        record = getattr(e, "record", None) or {
+            "config": config_file,
+            "total_time": round(time.time() - start_time, 2),
+        }
+        record["status"] = (
+            "interrupted" if isinstance(e, KeyboardInterrupt) else "error"
         )
-        logger.debug(
-            f"This patch total cost time: {int(end_time - start_time)} Seconds."
+        record["error"] = traceback.format_exc()
+        return record
+
+
+def _repo_of(config_file: str) -> str:
+    # jobs on the same clone share its working tree, they must run one at a time
+    try:
+        with open(config_file, "r") as file:
+            project_dir = yaml.safe_load(file).get("project_dir") or ""
+    except Exception:
+        return config_file
+    return os.path.realpath(os.path.expanduser(project_dir))
+
+
+def run_batch(manifest_file: str, debug_mode: bool) -> None:
+    """
+    Run every CVE config listed in a batch manifest through a pool of worker processes.
+
+    Jobs on different repositories run in parallel, jobs on the same repository run one
+    after another and reuse its on-disk caches (symbol index, blobs, worktrees). A record
+    is appended to the results file as each job finishes.
+
+    Args:
+        manifest_file (str): The path to the batch manifest yml.
+        debug_mode (bool): Enable debug mode.
+    """
+    with open(manifest_file, "r") as file:
+        manifest = yaml.safe_load(file)
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    workers = manifest.get("workers", 4)
+    results_file = os.path.join(
+        base_dir, manifest.get("results", "batch-results.jsonl")
+    )
+    jobs = [os.path.join(base_dir, job) for job in manifest.get("jobs", [])]
+
+    queues = {}
+    for config_file in jobs:
+        queues.setdefault(_repo_of(config_file), deque()).append(config_file)
+    logger.info(
+        f"Running {len(jobs)} jobs on {len(queues)} repositories with {workers} workers"
+    )
+
+    def write_record(record: dict) -> None:
+        with open(results_file, "a") as file:
+            file.write(json.dumps(record) + "\n")
+        logger.info(
+            f"Job {record['config']} {record['status']} in {record.get('total_time', 0)}s"
         )
 
-    shutil.copy(logfile, data.patch_dataset_dir)
+    # build containers of earlier batches that were killed
+    remove_stale_containers()
+    running = {}
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        while queues or running:
+            # start the next job of each idle repository
+            for repo in list(queues):
+                if len(running) >= workers:
+                    break
+                if repo in running.values():
+                    continue
+                config_file = queues[repo].popleft()
+                if not queues[repo]:
+                    del queues[repo]
+                future = executor.submit(_run_batch_job, config_file, debug_mode)
+                future.config_file = config_file
+                running[future] = repo
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                try:
+                    write_record(future.result())
+                except BrokenProcessPool:
+                    write_record(
+                        {
+                            "config": future.config_file,
+                            "status": "error",
+                            "error": "worker process crashed",
+                        }
+                    )
+            if any(isinstance(f.exception(), BrokenProcessPool) for f in done):
+                # a crashed worker breaks the whole pool, jobs still running are lost
+                for future in running:
+                    write_record(
+                        {
+                            "config": future.config_file,
+                            "status": "error",
+                            "error": "worker process crashed",
+                        }
+                    )
+                running.clear()
+                executor.shutdown(wait=False)
+                # the dead workers never removed their build containers
+                remove_stale_containers(os.getpid())
+                executor = ProcessPoolExecutor(max_workers=workers)
+    except KeyboardInterrupt:
+        logger.warning("Batch interrupted, recording unfinished jobs")
+        pending = [future.config_file for future in running]
+        pending += [config_file for queue in queues.values() for config_file in queue]
+        for config_file in pending:
+            write_record({"config": config_file, "status": "interrupted"})
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    # process arguments
+    parser = argparse.ArgumentParser(
+        description="Backports patch with the help of LLM",
+        usage="%(prog)s --config CONFIG.yml\ne.g.: python %(prog)s --config CVE-examaple.yml",
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-c", "--config", type=str, help="CVE config yml")
+    group.add_argument(
+        "-b", "--batch", type=str, help="batch manifest yml listing CVE configs"
+    )
+    parser.add_argument("-d", "--debug", action="store_true", help="enable debug mode")
+    args = parser.parse_args()
+    debug_mode = args.debug
+    if debug_mode:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.INFO)
+
+    if args.batch:
+        run_batch(args.batch, debug_mode)
+    else:
+        run_job(args.config, debug_mode)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,123 @@
+import mmap
+import os
+import tempfile
+import threading
+from typing import Callable, Iterator, List
+
+import numpy as np
+
+
+class BlobStore:
+    """
+    Blobs materialized once as local files, each with a precomputed array of newline offsets.
+
+    Line ranges are served by memory-mapping the file and decoding only the requested bytes,
+    so reading a few lines costs the same for a small file and a multi-MB generated one.
+
+    Materializing a blob again refreshes its mtime, so once the store grows beyond `max_bytes`
+    the least recently used blobs are removed first.
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    def _paths(self, sha: str) -> tuple[str, str]:
+        directory = os.path.join(self.root, sha[:2])
+        return os.path.join(directory, sha), os.path.join(directory, f"{sha}.npy")
+
+    def _entries(self) -> Iterator[tuple[float, str, int]]:
+        for directory in os.scandir(self.root):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                # a blob with its offsets, temporary files of concurrent writers are skipped
+                if entry.name.startswith("tmp") or entry.name.endswith(".npy"):
+                    continue
+                try:
+                    stat = entry.stat()
+                    size = stat.st_size + os.path.getsize(f"{entry.path}.npy")
+                except FileNotFoundError:
+                    continue
+                yield stat.st_mtime, entry.name, size
+
+    def materialize(self, sha: str, loader: Callable[[], bytes]) -> None:
+        """
+        Write a blob and its newline offsets to the store unless they already exist.
+
+        Args:
+            sha (str): The blob SHA.
+            loader (Callable[[], bytes]): Reads the raw blob content.
+        """
+        data_path, index_path = self._paths(sha)
+        if os.path.exists(index_path):
+            try:
+                os.utime(data_path)
+                return
+            except FileNotFoundError:
+                # evicted meanwhile
+                pass
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        content = loader()
+        offsets = np.flatnonzero(np.frombuffer(content, dtype=np.uint8) == ord("\n"))
+        # write to temporary files first, concurrent readers only ever see complete files
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(data_path), delete=False
+        ) as f:
+            f.write(content)
+        os.replace(f.name, data_path)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(data_path), suffix=".npy", delete=False
+        ) as f:
+            np.save(f, offsets.astype(np.int64))
+        os.replace(f.name, index_path)
+        with self.lock:
+            self.size += len(content) + os.path.getsize(index_path)
+            if self.size > self.max_bytes:
+                self._evict(sha)
+
+    def _evict(self, keep: str) -> None:
+        # other processes share the directory, recount before removing anything
+        entries = sorted(self._entries())
+        self.size = sum(size for _, _, size in entries)
+        for _, sha, size in entries:
+            if self.size <= self.max_bytes:
+                break
+            if sha == keep:
+                continue
+            # the offsets first, without them the blob counts as missing
+            for path in reversed(self._paths(sha)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self.size -= size
+
+    def _offsets(self, sha: str) -> np.ndarray:
+        return np.load(self._paths(sha)[1], mmap_mode="r")
+
+    def line_count(self, sha: str) -> int:
+        """
+        Number of lines of a materialized blob, counted like `content.split("\\n")`.
+        """
+        return len(self._offsets(sha)) + 1
+
+    def read_lines(self, sha: str, startline: int, endline: int) -> List[str]:
+        """
+        Read lines `startline` through `endline` (1-based, inclusive) of a materialized blob.
+        """
+        if endline < startline:
+            return []
+        offsets = self._offsets(sha)
+        start = 0 if startline <= 1 else int(offsets[startline - 2]) + 1
+        with open(self._paths(sha)[0], "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            end = int(offsets[endline - 1]) if endline - 1 < len(offsets) else size
+            if start >= end:
+                return [""] * (endline - startline + 1)
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                content = data[start:end]
+        return content.decode("utf-8", errors="ignore").split("\n")
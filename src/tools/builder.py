@@ -0,0 +1,284 @@
+import os
+import queue
+import shlex
+import signal
+import subprocess
+import threading
+import time
+import uuid
+from typing import Callable, Dict, List, Tuple
+
+from tools.logger import logger
+
+# label of build containers, the pid of the process that started the job, e.g. a batch
+PARENT_LABEL = "backport-parent"
+
+
+class BuildTimeout(Exception):
+    """
+    Raised when the build of the complete patch does not finish in time. The job can not
+    go on, the patch has to be checked manually.
+    """
+
+
+def stream_output(
+    process: subprocess.Popen,
+    timeout: float,
+    should_stop: Callable[[str, str], bool] | None = None,
+) -> Tuple[str, str, bool]:
+    """
+    Read the output of a process line by line as it is produced.
+
+    Args:
+        process (subprocess.Popen): A process with text stdout and stderr pipes.
+        timeout (float): Seconds to wait for the process to finish.
+        should_stop (Callable[[str, str], bool] | None, optional): Called with the stream name
+            ("stdout" or "stderr") and each line, returning True stops reading. Defaults to None.
+
+    Returns:
+        Tuple[str, str, bool]: stdout, stderr read so far, and whether `should_stop` stopped the
+            reading. The process is still running in the latter case.
+
+    Raises:
+        subprocess.TimeoutExpired: If the process does not finish in time.
+    """
+    lines = queue.Queue()
+
+    def pump(name: str, pipe) -> None:
+        for line in pipe:
+            lines.put((name, line))
+        lines.put((name, None))
+
+    for name, pipe in (("stdout", process.stdout), ("stderr", process.stderr)):
+        threading.Thread(target=pump, args=(name, pipe), daemon=True).start()
+
+    output = {"stdout": [], "stderr": []}
+    deadline = time.monotonic() + timeout
+    open_pipes = 2
+    while open_pipes:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise subprocess.TimeoutExpired(process.args, timeout)
+        try:
+            name, line = lines.get(timeout=remaining)
+        except queue.Empty:
+            continue
+        if line is None:
+            open_pipes -= 1
+            continue
+        output[name].append(line)
+        if should_stop and should_stop(name, line):
+            return "".join(output["stdout"]), "".join(output["stderr"]), True
+    process.wait(max(deadline - time.monotonic(), 0))
+    return "".join(output["stdout"]), "".join(output["stderr"]), False
+
+
+def remove_stale_containers(parent: int | None = None) -> None:
+    """
+    Remove the build containers left behind by jobs that died without closing their project,
+    e.g. crashed batch workers.
+
+    Args:
+        parent (int | None, optional): Remove the containers of the jobs of this process, which
+            must have none running. Defaults to None, the containers whose parent is gone.
+    """
+    try:
+        containers = subprocess.run(
+            [
+                "docker",
+                "ps",
+                "-a",
+                "--filter",
+                f"label={PARENT_LABEL}",
+                "--format",
+                f'{{{{.Names}}}} {{{{.Label "{PARENT_LABEL}"}}}}',
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).stdout.split("\n")
+    except FileNotFoundError:
+        # no docker, no containers
+        return
+    stale = []
+    for container in containers:
+        name, _, pid = container.partition(" ")
+        if not name or not pid.isdigit():
+            continue
+        if parent is not None:
+            if int(pid) == parent:
+                stale.append(name)
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            stale.append(name)
+        except PermissionError:
+            pass
+    if stale:
+        subprocess.run(
+            ["docker", "rm", "-f"] + stale,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        logger.info(f"Removed {len(stale)} stale build containers.")
+
+
+class BuildExecutor:
+    """
+    Runs build commands in one long-lived container per job, or directly on the host.
+
+    The container is started on the first build with `docker run -d` and every build is a
+    `docker exec` into it, so the compiler caches and the object files left in the worktree
+    and the build directory survive between attempts and retries are incremental.
+
+    Builds see two extra environment variables: `BUILD_DIR`, a persistent directory for
+    out-of-tree builds of the working directory (e.g. `make O=$BUILD_DIR`), and
+    `CCACHE_DIR`, a ccache directory shared by every job. `/usr/lib/ccache` is put
+    first in `PATH`, so compilers go through ccache when the image has it installed.
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        image: str,
+        mounts: List[str],
+        build_root: str,
+        ccache_dir: str,
+    ):
+        self.mode = mode
+        self.image = image
+        self.mounts = mounts
+        self.build_root = build_root
+        self.ccache_dir = ccache_dir
+        self.container = None
+        os.makedirs(build_root, exist_ok=True)
+        os.makedirs(ccache_dir, exist_ok=True)
+
+    def build_dir(self, cwd: str) -> str:
+        """
+        The persistent build directory of a working directory, exported as `BUILD_DIR`.
+        """
+        # one build directory per worktree, i.e. per commit
+        build_dir = os.path.join(self.build_root, os.path.basename(cwd))
+        os.makedirs(build_dir, exist_ok=True)
+        return build_dir
+
+    def _env(self, cwd: str) -> Dict[str, str]:
+        return {"BUILD_DIR": self.build_dir(cwd), "CCACHE_DIR": self.ccache_dir}
+
+    def _start(self) -> None:
+        name = f"backport-build-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        command = ["docker", "run", "-d", "--rm", "--name", name]
+        # lets the batch remove the container if this process dies before close()
+        command += ["--label", f"{PARENT_LABEL}={os.getppid()}"]
+        for mount in self.mounts + [self.build_root, self.ccache_dir]:
+            command += ["-v", f"{mount}:{mount}"]
+        command += [self.image, "sleep", "infinity"]
+        subprocess.run(
+            command,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+        self.container = name
+        logger.debug(f"Started build container {name} from {self.image}.")
+
+    def _running(self) -> bool:
+        inspect = subprocess.run(
+            ["docker", "inspect", "-f", "{{.State.Running}}", self.container],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        return inspect.stdout.strip() == "true"
+
+    def popen(self, command: str, cwd: str) -> subprocess.Popen:
+        """
+        Start a shell command in the build environment.
+
+        Args:
+            command (str): The bash command to run, e.g. `bash build.sh`.
+            cwd (str): The working directory, it must be inside one of the mounts.
+
+        Returns:
+            subprocess.Popen: The process, with text stdout and stderr pipes.
+        """
+        pid_file = None
+        if self.mode == "local":
+            args = ["/bin/bash", "-c", command]
+            env = dict(os.environ, **self._env(cwd))
+            env["PATH"] = f"/usr/lib/ccache:{env.get('PATH', '')}"
+        else:
+            if self.container is None or not self._running():
+                self._start()
+            # the command leads its own process group inside the container, see kill()
+            pid_file = f"/tmp/{uuid.uuid4().hex}.pid"
+            args = ["docker", "exec", "-w", cwd]
+            for key, value in self._env(cwd).items():
+                args += ["-e", f"{key}={value}"]
+            args += [
+                self.container,
+                "setsid",
+                "-w",
+                "/bin/bash",
+                "-c",
+                f"echo $$ > {pid_file}; export PATH=/usr/lib/ccache:$PATH; "
+                f"exec /bin/bash -c {shlex.quote(command)}",
+            ]
+            env = None
+        process = subprocess.Popen(
+            args,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env,
+            text=True,
+            start_new_session=True,
+        )
+        process.pid_file = pid_file
+        return process
+
+    def kill(self, process: subprocess.Popen) -> None:
+        """
+        Stop a command started by `popen` together with every process it spawned.
+        """
+        if process.pid_file is not None:
+            # killing `docker exec` leaves the processes in the container running
+            subprocess.run(
+                [
+                    "docker",
+                    "exec",
+                    self.container,
+                    "/bin/sh",
+                    "-c",
+                    f"kill -KILL -- -$(cat {process.pid_file}); rm -f {process.pid_file}",
+                ],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        process.wait()
+
+    def close(self) -> None:
+        """
+        Remove the build container.
+        """
+        if self.container is not None:
+            subprocess.run(
+                ["docker", "rm", "-f", self.container],
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            logger.debug(f"Removed build container {self.container}.")
+            self.container = None
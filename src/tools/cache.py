@@ -0,0 +1,114 @@
+import threading
+from collections import Counter, OrderedDict
+from typing import Callable, Hashable, List
+
+from tools.logger import logger
+
+
+class LinesCache:
+    """
+    Bounded LRU cache of decoded file lines shared by every read path.
+
+    Entries are keyed by blob SHA for git objects, or by path, mtime and size for files
+    in the working tree, so a key never refers to stale content. The cached lists are
+    shared and must not be modified by callers.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(lines: List[str]) -> int:
+        # rough footprint of a list of str objects
+        return sum(map(len, lines)) + 64 * len(lines)
+
+    def get(self, key: Hashable, loader: Callable[[], List[str]]) -> List[str]:
+        """
+        Get the lines cached under `key`, calling `loader` on a miss.
+
+        Args:
+            key (Hashable): The cache key.
+            loader (Callable[[], List[str]]): Reads and decodes the lines when they are not cached.
+
+        Returns:
+            List[str]: The cached lines.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+            self.misses += 1
+
+        lines = loader()
+        size = self._sizeof(lines)
+        with self.lock:
+            if key not in self.entries and size <= self.max_bytes:
+                self.entries[key] = (lines, size)
+                self.size += size
+                self._evict()
+        return lines
+
+    def resize(self, max_bytes: int) -> None:
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_bytes and self.entries:
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+    def stats(self) -> str:
+        return (
+            f"{self.hits} hits, {self.misses} misses, "
+            f"{len(self.entries)} entries, {self.size / 1024 / 1024:.1f}/{self.max_bytes / 1024 / 1024:.0f} MB"
+        )
+
+
+class ToolMemo:
+    """
+    Results of the read-only tools within one agent session.
+
+    Keys hold the tool name, its arguments and the resolved commit SHA, so a result
+    is only reused while the content it was computed from is the same.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.hits = Counter()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple, loader: Callable[[], str]) -> str:
+        """
+        Get the result memoized under `key`, calling `loader` on a miss.
+
+        Args:
+            key (tuple): The tool name followed by everything its result depends on.
+            loader (Callable[[], str]): Runs the tool.
+
+        Returns:
+            str: The tool result.
+        """
+        tool = key[0]
+        with self.lock:
+            self.calls[tool] += 1
+            if key in self.results:
+                self.hits[tool] += 1
+                logger.debug(
+                    f"Reuse {tool} result, {self.hits[tool]}/{self.calls[tool]} calls of {tool} hit."
+                )
+                return self.results[key]
+        result = loader()
+        with self.lock:
+            self.results[key] = result
+        return result
+
+
+lines_cache = LinesCache(256 * 1024 * 1024)
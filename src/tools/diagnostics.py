@@ -0,0 +1,239 @@
+import os
+import re
+from typing import Dict, List
+
+import tools.utils as utils
+
+# file:line[:column]: severity: message, as printed by gcc and clang
+DIAGNOSTIC_LINE = re.compile(
+    r"^(?P<file>[^:\s][^:]*):(?P<line>\d+):(?:(?P<column>\d+):)? "
+    r"(?P<severity>fatal error|error|warning|note): (?P<message>.*)$"
+)
+# errors without a source location, e.g. from the linker or make
+OTHER_ERROR = re.compile(r"error:|undefined reference to", re.I)
+# "In file included from x.h:2," followed by "                 from x.c:3:"
+INCLUDED_FROM = re.compile(r"^(?:In file included|\s+) from (?P<file>[^:\s][^:]*):\d+")
+# errors the later errors of their translation unit mostly cascade from
+ROOT_CAUSE = re.compile(r"undeclared|unknown type name")
+HEADER_SUFFIXES = (".h", ".hh", ".hpp")
+
+# source excerpts and carets under a diagnostic, e.g. "  12 |   foo();" and "     |   ^~~"
+MAX_DETAIL_LINES = 6
+
+CHARS_PER_TOKEN = 4
+
+
+class Diagnostic:
+    """
+    One compiler error, with the notes and source excerpt printed under it.
+    """
+
+    def __init__(self, file: str, line: int, column: int, severity: str, message: str):
+        self.file = file
+        self.line = line
+        self.column = column
+        self.severity = severity
+        self.message = message
+        self.details: List[str] = []
+        self.hunk: int | None = None
+        # the source file compiled, the file itself unless it is a header
+        self.unit = file
+        # errors folded into this one: more errors on the same line, e.g. a header compiled
+        # in many units, and the same message elsewhere, e.g. an unknown type used all over
+        self.same_line = 0
+        self.also_at: List[str] = []
+
+    def location(self) -> str:
+        if self.column:
+            return f"{self.file}:{self.line}:{self.column}"
+        return f"{self.file}:{self.line}"
+
+    def render(self) -> str:
+        text = f"{self.location()}: {self.severity}: {self.message}"
+        if self.hunk is not None:
+            text += f" (in hunk {self.hunk} of the patch)"
+        text += "".join(f"\n{detail}" for detail in self.details)
+        if self.same_line:
+            text += f"\n({self.same_line} more errors on this line)"
+        if self.also_at:
+            text += (
+                f"\n(the same error at {len(self.also_at)} more locations, e.g. "
+                + ", ".join(self.also_at[:3])
+                + ")"
+            )
+        return text
+
+
+def parse_diagnostics(output: str, work_dir: str) -> tuple[List[Diagnostic], List[str]]:
+    """
+    Parse the errors in gcc or clang output. Warnings are dropped, notes and source excerpts
+    are attached to the error above them.
+
+    Args:
+        output (str): The build output.
+        work_dir (str): The directory built, absolute paths inside it are made relative.
+
+    Returns:
+        tuple[List[Diagnostic], List[str]]: Errors with a source location, and other error lines
+            such as linker errors, both in the order they were printed.
+    """
+    diagnostics = []
+    others = []
+    current = None
+    unit = None
+    for line in output.splitlines():
+        included = INCLUDED_FROM.match(line)
+        if included is not None:
+            # the last one of the chain is the source file compiled
+            unit = _relative(included["file"], work_dir)
+            current = None
+            continue
+        match = DIAGNOSTIC_LINE.match(line)
+        if match is None:
+            if current is not None and line[:1].isspace():
+                if len(current.details) < MAX_DETAIL_LINES:
+                    current.details.append(line.rstrip())
+                continue
+            current = None
+            if OTHER_ERROR.search(line):
+                others.append(line.strip())
+            continue
+
+        severity = match["severity"]
+        if severity == "note":
+            if current is not None and len(current.details) < MAX_DETAIL_LINES:
+                current.details.append(line.rstrip())
+            continue
+        if severity == "warning":
+            current = None
+            continue
+        file = _relative(match["file"], work_dir)
+        if not file.endswith(HEADER_SUFFIXES):
+            unit = file
+        current = Diagnostic(
+            file,
+            int(match["line"]),
+            int(match["column"] or 0),
+            severity,
+            match["message"],
+        )
+        current.unit = unit or file
+        diagnostics.append(current)
+    return diagnostics, others
+
+
+def _relative(file: str, work_dir: str) -> str:
+    file = os.path.normpath(file)
+    if os.path.isabs(file) and file.startswith(os.path.join(work_dir, "")):
+        file = os.path.relpath(file, work_dir)
+    return file
+
+
+def deduplicate(diagnostics: List[Diagnostic]) -> List[Diagnostic]:
+    """
+    Fold cascades into their first occurrence: errors printed again at the same file:line,
+    and errors repeating the same message at other locations. A repeated message in a hunk
+    of the patch is only folded after a fatal error or an undeclared name in the same
+    translation unit, otherwise it may well be a mistake of its own.
+
+    Args:
+        diagnostics (List[Diagnostic]): Errors in the order they were printed, mapped to
+            the hunks of the patch.
+
+    Returns:
+        List[Diagnostic]: The first error of each group, in the order they were printed.
+    """
+    by_location: Dict[tuple, Diagnostic] = {}
+    by_message: Dict[str, Diagnostic] = {}
+    # translation units with a fatal error or an undeclared name so far
+    broken_units = set()
+    unique = []
+    for diagnostic in diagnostics:
+        first = by_location.get((diagnostic.file, diagnostic.line))
+        if first is not None:
+            first.same_line += 1
+            continue
+        by_location[(diagnostic.file, diagnostic.line)] = diagnostic
+        first = by_message.get(diagnostic.message)
+        if first is not None and (
+            diagnostic.hunk is None or diagnostic.unit in broken_units
+        ):
+            first.also_at.append(f"{diagnostic.file}:{diagnostic.line}")
+            continue
+        if diagnostic.severity == "fatal error" or ROOT_CAUSE.search(
+            diagnostic.message
+        ):
+            broken_units.add(diagnostic.unit)
+        by_message.setdefault(diagnostic.message, diagnostic)
+        unique.append(diagnostic)
+    return unique
+
+
+def map_to_hunks(
+    diagnostics: List[Diagnostic], hunks: List[str], work_dir: str
+) -> None:
+    """
+    Set the index of the hunk whose lines each error points to, if any.
+
+    Args:
+        diagnostics (List[Diagnostic]): The errors.
+        hunks (List[str]): The hunks applied to the working directory, as split by `split_patch`.
+        work_dir (str): The patched working directory.
+    """
+    line_maps = {}
+    for diagnostic in diagnostics:
+        path = os.path.join(work_dir, diagnostic.file)
+        if diagnostic.file not in line_maps:
+            line_maps[diagnostic.file] = []
+            if os.path.isfile(path):
+                file_lines = utils.read_file_lines(path)
+                line_maps[diagnostic.file] = [
+                    utils.map_patch_lines(hunk, diagnostic.file, file_lines)
+                    for hunk in hunks
+                ]
+        for idx, line_map in enumerate(line_maps[diagnostic.file]):
+            if diagnostic.line in line_map:
+                diagnostic.hunk = idx
+                break
+
+
+def summarize(output: str, hunks: List[str], work_dir: str, max_tokens: int) -> str:
+    """
+    Reduce build output to its root-cause errors within a token budget.
+
+    Fatal errors come first, then errors in lines of the patch, then the rest, each in the
+    order they were printed, since later errors are mostly cascades of earlier ones.
+
+    Args:
+        output (str): The build output.
+        hunks (List[str]): The hunks applied to the working directory, as split by `split_patch`.
+        work_dir (str): The patched working directory.
+        max_tokens (int): Budget of the summary, estimated at 4 characters per token.
+
+    Returns:
+        str: The errors, each with its notes and source excerpt, and how many were left out.
+    """
+    diagnostics, others = parse_diagnostics(output, work_dir)
+    map_to_hunks(diagnostics, hunks, work_dir)
+    diagnostics = deduplicate(diagnostics)
+    diagnostics.sort(
+        key=lambda diagnostic: (
+            diagnostic.severity != "fatal error",
+            diagnostic.hunk is None,
+        )
+    )
+    blocks = [diagnostic.render() for diagnostic in diagnostics]
+    blocks += list(dict.fromkeys(others))
+
+    kept = []
+    budget = max_tokens * CHARS_PER_TOKEN
+    for block in blocks:
+        # always keep the first error, even a huge one
+        if kept and len(block) + 1 > budget:
+            break
+        kept.append(block)
+        budget -= len(block) + 1
+    summary = "\n".join(kept)
+    if len(kept) < len(blocks):
+        summary += f"\n... and {len(blocks) - len(kept)} more errors left out."
+    return summary
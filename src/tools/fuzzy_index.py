@@ -0,0 +1,76 @@
+import heapq
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+import Levenshtein
+
+
+def _ngrams(text: str, n: int) -> Set[str]:
+    padded = "\0" * (n - 1) + text + "\0" * (n - 1)
+    return {padded[i : i + n] for i in range(len(padded) - n + 1)}
+
+
+class FuzzyIndex:
+    """
+    N-gram inverted index for bounded Levenshtein search over a fixed set of keys.
+
+    A key within edit distance `d` of the query shares at least `|grams(query)| - n * d`
+    distinct n-grams with it, so only keys reaching that count are compared exactly.
+    """
+
+    def __init__(self, keys: Iterable[str], n: int = 3):
+        self.n = n
+        self.keys = list(dict.fromkeys(keys))
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        self.lengths: Dict[int, List[int]] = defaultdict(list)
+        for idx, key in enumerate(self.keys):
+            self.lengths[len(key)].append(idx)
+            for gram in _ngrams(key, n):
+                self.postings[gram].append(idx)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def search(
+        self, query: str, k: int = 5, max_distance: int | None = None
+    ) -> List[Tuple[int, str]]:
+        """
+        Find the k keys nearest to the query.
+
+        Args:
+            query (str): The string to look for.
+            k (int, optional): Number of results. Defaults to 5.
+            max_distance (int | None, optional): Maximum edit distance of a result. Defaults to a third of the query length.
+
+        Returns:
+            List[Tuple[int, str]]: (distance, key) tuples sorted by distance.
+        """
+        if max_distance is None:
+            max_distance = max(2, len(query) // 3)
+
+        grams = _ngrams(query, self.n)
+        threshold = len(grams) - self.n * max_distance
+        if threshold > 0:
+            counter = Counter()
+            for gram in grams:
+                counter.update(self.postings.get(gram, ()))
+            candidates = (idx for idx, count in counter.items() if count >= threshold)
+        else:
+            # the query is too short for the n-gram filter, scan keys of a similar length
+            candidates = (
+                idx
+                for length in range(
+                    max(0, len(query) - max_distance), len(query) + max_distance + 1
+                )
+                for idx in self.lengths.get(length, ())
+            )
+
+        results = []
+        for idx in candidates:
+            key = self.keys[idx]
+            if abs(len(key) - len(query)) > max_distance:
+                continue
+            distance = Levenshtein.distance(query, key, score_cutoff=max_distance)
+            if distance <= max_distance:
+                results.append((distance, key))
+        return heapq.nsmallest(k, results)
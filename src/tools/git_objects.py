@@ -0,0 +1,100 @@
+import subprocess
+import threading
+from typing import Tuple
+
+
+class GitObjectReader:
+    """
+    Long-lived `git cat-file --batch` and `--batch-check` processes of one repository.
+
+    Object lookups are streamed through the two pipes instead of spawning a `git` process
+    per call. Both accept any object name understood by `git rev-parse`, such as
+    `<commit>^{commit}` or `<commit>:<path>`.
+    """
+
+    def __init__(self, repo_dir: str):
+        self.repo_dir = repo_dir
+        self.batch = None
+        self.batch_check = None
+        self.batch_lock = threading.Lock()
+        self.batch_check_lock = threading.Lock()
+
+    def _start(self, option: str) -> subprocess.Popen:
+        return subprocess.Popen(
+            ["git", "cat-file", option],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.repo_dir,
+        )
+
+    @staticmethod
+    def _request(process: subprocess.Popen, name: str) -> list[bytes] | None:
+        if "\n" in name:
+            raise ValueError(f"Invalid object name {name!r}")
+        process.stdin.write(f"{name}\n".encode())
+        process.stdin.flush()
+        header = process.stdout.readline().split()
+        # "<name> missing" and "<name> ambiguous", where the name may contain spaces
+        if header[-1:] in ([b"missing"], [b"ambiguous"]) or len(header) != 3:
+            return None
+        return header
+
+    def info(self, name: str) -> Tuple[str, str, int] | None:
+        """
+        Look up the SHA, type and size of an object.
+
+        Args:
+            name (str): The object name.
+
+        Returns:
+            Tuple[str, str, int] | None: (sha, type, size), or None if the object does not exist.
+        """
+        with self.batch_check_lock:
+            if self.batch_check is None or self.batch_check.poll() is not None:
+                self.batch_check = self._start("--batch-check")
+            header = self._request(self.batch_check, name)
+        if header is None:
+            return None
+        return header[0].decode(), header[1].decode(), int(header[2])
+
+    def read(self, name: str) -> Tuple[str, str, bytes] | None:
+        """
+        Read the content of an object.
+
+        Args:
+            name (str): The object name.
+
+        Returns:
+            Tuple[str, str, bytes] | None: (sha, type, content), or None if the object does not exist.
+        """
+        with self.batch_lock:
+            if self.batch is None or self.batch.poll() is not None:
+                self.batch = self._start("--batch")
+            header = self._request(self.batch, name)
+            if header is None:
+                return None
+            content = self.batch.stdout.read(int(header[2]))
+            # every object is followed by a newline
+            self.batch.stdout.read(1)
+        return header[0].decode(), header[1].decode(), content
+
+    def resolve(self, ref: str) -> str:
+        """
+        Resolve a ref to a commit SHA.
+
+        Raises:
+            ValueError: If the ref does not name a commit.
+        """
+        info = self.info(f"{ref}^{{commit}}")
+        if info is None:
+            raise ValueError(f"Invalid commit {ref}")
+        return info[0]
+
+    def close(self) -> None:
+        for process in (self.batch, self.batch_check):
+            if process is not None and process.poll() is None:
+                process.stdin.close()
+                process.wait()
+        self.batch = None
+        self.batch_check = None
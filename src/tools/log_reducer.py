@@ -0,0 +1,146 @@
+import re
+from typing import List, Tuple
+
+CHARS_PER_TOKEN = 4
+# longer lines, e.g. dumped buffers, are cut
+MAX_LINE_CHARS = 400
+
+# autotools/pytest "FAIL: x" and "FAILED x", TAP "not ok 3 - x", gtest "[  FAILED  ] x",
+# ctest "Test #3: x ....***Failed"
+FAILED_TEST = re.compile(
+    r"^\s*(?:FAIL(?:ED)?\b|ERROR:|not ok\b|\[\s+FAILED\s+\])|\*\*\*Failed"
+)
+# ASan/MSan/TSan/LSan and UBSan reports, KASAN/KCSAN and other kernel splats
+SANITIZER_START = re.compile(
+    r"==\d+==\s*(?:ERROR|WARNING): \w*Sanitizer|runtime error:|^\s*(?:\[[\s\d.]+\]\s*)?BUG: K\w*SAN"
+)
+SANITIZER_END = re.compile(
+    r"^\s*SUMMARY: \w*Sanitizer|==\d+==ABORTING|^\s*(?:\[[\s\d.]+\]\s*)?(?:=+|---\[ end trace .*)$"
+)
+STACK_FRAME = re.compile(r"^\s*#\d+ 0x[0-9a-fA-F]+ ")
+
+
+def _cut(line: str) -> str:
+    if len(line) > MAX_LINE_CHARS:
+        return line[:MAX_LINE_CHARS] + " [...]"
+    return line
+
+
+def failed_tests(lines: List[str]) -> List[str]:
+    """
+    The lines naming failed tests, without repetitions.
+    """
+    return list(
+        dict.fromkeys(line.strip() for line in lines if FAILED_TEST.search(line))
+    )
+
+
+def sanitizer_reports(lines: List[str], patched_files: List[str]) -> List[str]:
+    """
+    The sanitizer reports in a log, keeping of each stack only its first frame and the
+    frames in files changed by the patch.
+
+    Args:
+        lines (List[str]): The lines of the log.
+        patched_files (List[str]): The files changed by the patch, relative to the repository root.
+
+    Returns:
+        List[str]: The lines of the reports, skipped frames replaced by "...".
+    """
+    kept = []
+    in_report = False
+    first_frame = True
+    for line in lines:
+        if SANITIZER_START.search(line):
+            in_report = True
+            # UBSan prints a single line, at most followed by a stack
+            stack_only = "runtime error:" in line
+            first_frame = True
+            kept.append(line)
+            continue
+        if not in_report:
+            continue
+        if STACK_FRAME.match(line):
+            relevant = any(
+                f"/{path}:" in line or f" {path}:" in line for path in patched_files
+            )
+            if first_frame or relevant:
+                kept.append(line)
+            elif kept[-1].strip() != "...":
+                kept.append("    ...")
+            first_frame = False
+            continue
+        if not line.strip():
+            # a blank line ends a stack, the next one, e.g. "freed by thread T0 here:", follows
+            first_frame = True
+            continue
+        if stack_only:
+            in_report = False
+            continue
+        kept.append(line)
+        if SANITIZER_END.search(line):
+            in_report = False
+    return kept
+
+
+def reduce_log(
+    log: str,
+    patched_files: List[str],
+    max_tokens: int,
+    markers: Tuple[str, ...] = (),
+) -> str:
+    """
+    Reduce a test or PoC log to what explains the failure, within a token budget: the failed
+    tests, the sanitizer reports with their frames in the patched files, and the last lines.
+
+    Args:
+        log (str): The output of the test or PoC.
+        patched_files (List[str]): The files changed by the patch, relative to the repository root.
+        max_tokens (int): Budget of the reduced log, estimated at 4 characters per token.
+        markers (Tuple[str, ...], optional): Lines containing any of them are kept as well, e.g.
+            the expected PoC error. Defaults to ().
+
+    Returns:
+        str: The reduced log, or the log itself if it fits the budget.
+    """
+    budget = max_tokens * CHARS_PER_TOKEN
+    if len(log) <= budget:
+        return log
+
+    lines = log.splitlines()
+    sections = [
+        ("Failed tests", failed_tests(lines)),
+        ("Sanitizer reports", sanitizer_reports(lines, patched_files)),
+        (
+            "Lines with the expected error",
+            [line for line in lines if any(marker in line for marker in markers)],
+        ),
+    ]
+    parts = []
+    # each section may take half of what is left, the rest goes to the tail
+    for title, section in sections:
+        if not section:
+            continue
+        share = budget // 2
+        kept = []
+        for line in map(_cut, section):
+            if len(line) + 1 > share:
+                break
+            kept.append(line)
+            share -= len(line) + 1
+        text = f"{title}:\n" + "\n".join(kept)
+        if len(kept) < len(section):
+            text += f"\n... {len(section) - len(kept)} more lines"
+        parts.append(text)
+        budget -= len(text) + 1
+
+    tail = []
+    for line in map(_cut, reversed(lines)):
+        if len(line) + 1 > budget:
+            break
+        tail.append(line)
+        budget -= len(line) + 1
+    parts.append(
+        f"Last {len(tail)} of {len(lines)} lines:\n" + "\n".join(reversed(tail))
+    )
+    return "\n\n".join(parts)
@@ -6,10 +6,11 @@ logger = logging.getLogger("backport")
 logger.addHandler(RichHandler())
 
 
-def add_file_handler(logger: logging.Logger, filename: str):
+def add_file_handler(logger: logging.Logger, filename: str) -> logging.Handler:
     formatter = logging.Formatter(
         "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
     )
     file_handler = logging.FileHandler(filename)
     file_handler.setFormatter(formatter)
     logger.addHandler(file_handler)
+    return file_handler
@@ -1,16 +1,33 @@
+import copy
+import hashlib
+import json
 import os
 import re
+import shlex
+import shutil
 import subprocess
 import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from types import SimpleNamespace
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 
-import Levenshtein
 from git import Repo
 from langchain_core.tools import tool
 
 import tools.utils as utils
+from tools import builder, diagnostics, log_reducer, syntax
+from tools.blob_store import BlobStore
+from tools.builder import BuildExecutor, BuildTimeout
+from tools.cache import ToolMemo, lines_cache
+from tools.fuzzy_index import FuzzyIndex
+from tools.git_objects import GitObjectReader
 from tools.logger import logger
+from tools.symbol_index import SymbolIndex
+from tools.worktree import WorktreePool
+
+# scripts of the patch dataset run in the worktree
+DATASET_SCRIPTS = ("build.sh", "test.sh", "poc.sh")
 
 
 class Project:
@@ -33,16 +50,126 @@ class Project:
         self.compile_succeeded = False
         self.testcase_succeeded = False
         self.poc_succeeded = False
-        self.symbol_map = {}
+        self.cache_dir = data.cache_dir
+        self.patch_dataset_dir = data.patch_dataset_dir
+        repo_key = hashlib.sha1(os.path.abspath(self.dir).encode()).hexdigest()[:16]
+        build_root = os.path.join(self.cache_dir, "build", repo_key)
+        self.worktree_pool = WorktreePool(
+            self.repo,
+            os.path.join(self.cache_dir, "worktrees", repo_key),
+            data.max_worktrees,
+            build_root,
+        )
+        # worktrees point into the object database of the shared clone, builds may run git
+        self.builder = BuildExecutor(
+            data.build_mode,
+            data.build_image,
+            [self.worktree_pool.pool_dir, os.path.abspath(self.repo.common_dir)],
+            build_root,
+            data.ccache_dir,
+        )
+        self.work_dir = None
+        self.work_repo = None
+        self.objects = GitObjectReader(self.dir)
+        self.symbol_index = SymbolIndex(os.path.join(self.cache_dir, "symbols.db"))
+        self.fuzzy_indexes = {}
+        self.file_indexes = {}
+        self.blobs = {}
+        self.blob_store = BlobStore(
+            os.path.join(self.cache_dir, "blobs"), data.blob_cache_mb * 1024 * 1024
+        )
+        self.index_dir = tempfile.TemporaryDirectory()
+        self.index_files = {}
+        self.index_lock = threading.Lock()
+        lines_cache.resize(data.lines_cache_mb * 1024 * 1024)
+        self.fuzzy_index_lock = threading.Lock()
+        self.prepare_lock = threading.Lock()
         self.now_hunk = ""
         self.now_hunk_num = 0
         self.hunk_log_info = {}
         self.add_percent = 0
         self.last_context = []
+        self.stage_times = {}
+        self.validation_cache = data.validation_cache
+        self.max_build_errors = data.max_build_errors
+        # set by the stages of a validation whose outcome says nothing about the patch, e.g.
+        # one that gave up waiting
+        self.inconclusive = False
+        self.prebuild = data.prebuild
+        self.prebuild_make_args = data.prebuild_make_args
+        self.syntax_check = data.syntax_check
+        self.feedback_tokens = data.feedback_tokens
+        self.log_dir = data.log_dir
+        self.log_prefix = f"{data.project}-{data.tag}"
+        self.compile_commands = {}
+        self.history = {}
+        self.history_lock = threading.Lock()
+        self.history_worker = ThreadPoolExecutor(max_workers=1)
 
     def _checkout(self, ref: str) -> None:
-        self.repo.git.reset("--hard")
-        self.repo.git.checkout(ref)
+        """
+        Check out a ref in its pooled worktree, which becomes the working directory of build, test and PoC.
+        The shared checkout at `self.dir` is never modified. Files of the patch dataset (build.sh, test.sh, poc.sh...)
+        are copied into the worktree, leftovers of earlier jobs on the same commit are removed first.
+        """
+        sha = self._resolve_ref(ref)
+        if self.work_dir and os.path.basename(self.work_dir) != sha:
+            self.worktree_pool.release(os.path.basename(self.work_dir))
+            self.work_dir = None
+        if not self.work_dir:
+            self.work_dir = self.worktree_pool.acquire(sha)
+            self.work_repo = Repo(self.work_dir)
+        self.work_repo.git.reset("--hard")
+        # files added by earlier patches and dataset files, ignored build outputs are kept
+        # for incremental builds
+        self.work_repo.git.clean("-fd")
+        self.work_repo.git.checkout(sha)
+        for script in DATASET_SCRIPTS:
+            path = os.path.join(self.work_dir, script)
+            if (
+                not os.path.exists(os.path.join(self.patch_dataset_dir, script))
+                and os.path.exists(path)
+                and not self.work_repo.git.ls_files(script)
+            ):
+                # e.g. poc.sh of another CVE, ignored by the project
+                os.remove(path)
+        for file in os.listdir(self.patch_dataset_dir):
+            shutil.copy2(
+                os.path.join(self.patch_dataset_dir, file),
+                os.path.join(self.work_dir, file),
+            )
+
+    def fork(self) -> "Project":
+        """
+        Create a view of the project for backporting one hunk in its own thread.
+
+        The fork has its own per-hunk state and git handle, while caches, indexes and
+        locks are shared with the original project.
+
+        Returns:
+            Project: The forked project.
+        """
+        fork = copy.copy(self)
+        fork.repo = Repo(self.dir)
+        fork.succeeded_patches = []
+        fork.context_mismatch_times = 0
+        fork.round_succeeded = False
+        fork.now_hunk = ""
+        fork.now_hunk_num = 0
+        fork.hunk_log_info = {}
+        fork.add_percent = 0
+        fork.last_context = []
+        fork.stage_times = {}
+        return fork
+
+    def close(self) -> None:
+        """
+        Release the worktrees locked by this project and stop its background processes.
+        """
+        self.worktree_pool.release_all()
+        self.history_worker.shutdown(wait=False, cancel_futures=True)
+        self.objects.close()
+        self.builder.close()
 
     def _get_patch(self, ref: str) -> str:
         try:
@@ -50,36 +177,144 @@ class Project:
         except:
             return "Error commit id, please check if the commit id is correct."
 
-    def _prepare(self, ref: str) -> None:
+    def _resolve_ref(self, ref: str) -> str:
+        return self.objects.resolve(ref)
+
+    def _list_tree(self, sha: str) -> List[Tuple[str, str]]:
         """
-        Prepares the project by generating a symbol map using ctags.
+        List the regular files of a commit with `git ls-tree`.
 
-        Raises:
-            subprocess.CalledProcessError: If the ctags command fails.
+        Returns:
+            List[Tuple[str, str]]: (path, blob) tuples, symlinks and submodules excluded.
         """
-        ctags = subprocess.run(
-            ["ctags", "--excmd=number", "-R", "."],
+        output = subprocess.run(
+            ["git", "ls-tree", "-r", "-z", sha],
             stdout=subprocess.PIPE,
             cwd=self.dir,
+            stdin=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        output.check_returncode()
+        files = []
+        for entry in output.stdout.decode("utf-8", errors="surrogateescape").split(
+            "\0"
+        ):
+            if not entry:
+                continue
+            info, path = entry.split("\t", 1)
+            mode, type, blob = info.split(" ")
+            if type == "blob" and mode != "120000":
+                files.append((path, blob))
+        return files
+
+    def _get_file_index(self, ref: str) -> Tuple[Dict[str, List[str]], FuzzyIndex]:
+        """
+        Get the file name index of the files tracked in a specific ref, built once per ref.
+
+        Returns:
+            Tuple[Dict[str, List[str]], FuzzyIndex]: File paths grouped by file name, and a fuzzy index over the file names.
+        """
+        sha = self._resolve_ref(ref)
+        with self.fuzzy_index_lock:
+            if sha not in self.file_indexes:
+                file_paths = {}
+                for path, _ in self._list_tree(sha):
+                    file_paths.setdefault(path.split("/")[-1], []).append(path)
+                self.file_indexes[sha] = (file_paths, FuzzyIndex(file_paths))
+        return self.file_indexes[sha]
+
+    def _find_similar_files(self, ref: str, path: str) -> List[str]:
+        file_paths, file_index = self._get_file_index(ref)
+        return utils.find_most_similar_files(
+            path.split("/")[-1], file_paths, file_index
+        )
+
+    def _export_blobs(self, blobs: Dict[str, str], dst: str) -> None:
+        """
+        Write blobs into `dst` straight from the object database with `git cat-file --batch`.
+
+        Args:
+            blobs (Dict[str, str]): Mapping from blob SHA to the relative path it is written to.
+            dst (str): Destination directory.
+        """
+        cat_file = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
             stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
             stderr=subprocess.DEVNULL,
+            cwd=self.dir,
         )
-        ctags.check_returncode()
 
-        self.symbol_map[ref] = {}
-        with open(os.path.join(self.dir, "tags"), "rb") as f:
-            for line in f.readlines():
-                if text := line.decode("utf-8", errors="ignore"):
-                    if text.startswith("!_TAG_"):
-                        continue
-                    try:
-                        symbol, file, lineno = text.strip().split(';"')[0].split("\t")
-                        lineno = int(lineno)
-                        if symbol not in self.symbol_map[ref]:
-                            self.symbol_map[ref][symbol] = []
-                        self.symbol_map[ref][symbol].append((file, lineno))
-                    except:
-                        continue
+        def feed():
+            for blob in blobs:
+                cat_file.stdin.write(f"{blob}\n".encode())
+            cat_file.stdin.close()
+
+        # feed object names from another thread, otherwise both pipes may fill up
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        for blob, path in blobs.items():
+            header = cat_file.stdout.readline().split()
+            if len(header) < 3:
+                raise subprocess.CalledProcessError(-1, cat_file.args)
+            content = cat_file.stdout.read(int(header[2]))
+            cat_file.stdout.read(1)
+            file_path = os.path.join(dst, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as f:
+                f.write(content)
+        feeder.join()
+        cat_file.wait()
+
+    def _prepare(self, ref: str) -> None:
+        """
+        Prepares the project by generating a symbol map using ctags and storing it in the symbol index.
+        Tags are cached per blob, so only blobs that have never been seen are exported from the
+        object database and analyzed. HEAD and the working tree never change.
+
+        Raises:
+            subprocess.CalledProcessError: If the ctags command fails.
+        """
+        sha = self._resolve_ref(ref)
+        files = self._list_tree(sha)
+        missing = self.symbol_index.missing_blobs(blob for _, blob in files)
+        logger.debug(
+            f"Indexing symbols of {sha}, {len(missing)}/{len(files)} files need ctags."
+        )
+        if missing:
+            blobs = {}
+            for path, blob in files:
+                if blob in missing and blob not in blobs:
+                    blobs[blob] = path
+            path_blob = {path: blob for blob, path in blobs.items()}
+            tags = {}
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tree_dir = os.path.join(tmp_dir, "tree")
+                self._export_blobs(blobs, tree_dir)
+                ctags = subprocess.run(
+                    ["ctags", "--excmd=number", "-f", "../tags", "-R", "."],
+                    stdout=subprocess.PIPE,
+                    cwd=tree_dir,
+                    stdin=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                )
+                ctags.check_returncode()
+
+                with open(os.path.join(tmp_dir, "tags"), "rb") as f:
+                    for line in f.readlines():
+                        if text := line.decode("utf-8", errors="ignore"):
+                            if text.startswith("!_TAG_"):
+                                continue
+                            try:
+                                symbol, file, lineno = (
+                                    text.strip().split(';"')[0].split("\t")
+                                )
+                                blob = path_blob[os.path.normpath(file)]
+                                tags.setdefault(blob, []).append((symbol, int(lineno)))
+                            except:
+                                continue
+            self.symbol_index.add_blobs(blobs, tags)
+        self.symbol_index.add_ref(sha, files)
 
     def _viewcode(self, ref: str, path: str, startline: int, endline: int) -> str:
         """
@@ -96,37 +331,86 @@ class Project:
                  If the file doesn't exist in the commit, a message indicating that is returned.
         """
         try:
-            file = self.repo.tree(ref) / path
+            blob = self._get_blob(ref, path)
         except:
             return "This file doesn't exist in this commit."
-        content = file.data_stream.read().decode("utf-8", errors="ignore")
-        lines = content.split("\n")
+        # serve the range from the memory-mapped blob, cost depends on the range size only
+        self.blob_store.materialize(blob, lambda: self._read_blob(blob))
+        num_lines = self.blob_store.line_count(blob)
         ret = []
-        if not lines:
-            return "This file is empty.\n"
         if startline > endline:
             startline, endline = endline, startline
         startline = max(1, startline)
-        if startline > len(lines):
-            ret.append(
-                f"This file only has {len(lines)} lines. Showing full file.\n"
-            )
+        if startline > num_lines:
+            ret.append(f"This file only has {num_lines} lines. Showing full file.\n")
             startline = 1
-            endline = len(lines)
-        elif endline > len(lines):
-            endline = len(lines)
+            endline = num_lines
+        elif endline > num_lines:
+            endline = num_lines
             ret.append(
-                f"This file only has {len(lines)} lines. Here are lines {startline} through {endline}.\n"
+                f"This file only has {num_lines} lines. Here are lines {startline} through {endline}.\n"
             )
         else:
             ret.append(f"Here are lines {startline} through {endline}.\n")
-        for i in range(startline - 1, endline):
-            ret.append(lines[i])
+        ret.extend(self.blob_store.read_lines(blob, startline, endline))
         return (
             "\n".join(ret)
             + "\nBased on the previous information, think carefully do you see the target code? You may want to keep checking if you don't.\n"
         )
 
+    def _get_blob(self, ref: str, path: str) -> str:
+        """
+        Get the blob SHA of a file in a specific ref.
+
+        Raises:
+            KeyError: If the file doesn't exist in the ref.
+        """
+        sha = self._resolve_ref(ref)
+        if (sha, path) not in self.blobs:
+            info = self.objects.info(f"{sha}:{path}")
+            if info is None or info[1] != "blob":
+                raise KeyError(path)
+            self.blobs[(sha, path)] = info[0]
+        return self.blobs[(sha, path)]
+
+    def _read_blob(self, blob: str) -> bytes:
+        return self.objects.read(blob)[2]
+
+    def _read_lines(self, ref: str, path: str, splitlines: bool = False) -> List[str]:
+        """
+        Read the lines of a file from a specific ref through the shared LRU cache keyed by blob SHA.
+
+        Args:
+            ref (str): The reference of the target repository.
+            path (str): The path of the file.
+            splitlines (bool, optional): Split like `utils.read_file_lines` instead of `split("\\n")`. Defaults to False.
+
+        Raises:
+            KeyError: If the file doesn't exist in the ref.
+        """
+        blob = self._get_blob(ref, path)
+
+        def load() -> List[str]:
+            content = self._read_blob(blob).decode("utf-8", errors="ignore")
+            if splitlines:
+                return [line.rstrip("\n") for line in content.splitlines()]
+            return content.split("\n")
+
+        return lines_cache.get(("blob", blob, splitlines), load)
+
+    def _get_index_file(self, ref: str) -> str:
+        """
+        Get a private index file holding the tree of a specific ref, built once per ref with `git read-tree`.
+        Patches are checked against it with `git apply --cached`, so HEAD and the working tree stay untouched.
+        """
+        sha = self._resolve_ref(ref)
+        with self.index_lock:
+            if sha not in self.index_files:
+                index_file = os.path.join(self.index_dir.name, sha)
+                self.repo.git.read_tree(sha, env={"GIT_INDEX_FILE": index_file})
+                self.index_files[sha] = index_file
+        return self.index_files[sha]
+
     def _locate_symbol(self, ref: str, symbol: str) -> List[Tuple[str, int]] | None:
         """
         Locate a symbol in a specific ref of the target repository.
@@ -138,42 +422,116 @@ class Project:
         Returns:
             List[Tuple[str, int]] | None: File path and code lines.
         """
-        # XXX: Analyzing ctags file everytime locate symbol is time-consuming.
-        if ref not in self.symbol_map:
-            self._checkout(ref)
-            self._prepare(ref)
+        sha = self._resolve_ref(ref)
+        with self.prepare_lock:
+            if not self.symbol_index.has_ref(sha):
+                self._prepare(sha)
 
-        if symbol in self.symbol_map[ref]:
-            return self.symbol_map[ref][symbol]
-        else:
-            return None
+        return self.symbol_index.lookup(sha, symbol)
 
     def _locate_similar_symbol(
-        self, ref: str, symbol: str
-    ) -> List[Tuple[str, int]] | None:
+        self, ref: str, symbol: str, top_k: int = 5
+    ) -> List[Tuple[str, List[Tuple[str, int]]]]:
         """
-        Locate the most similar symbol with llm need in a specific ref of the target repository.
+        Locate the most similar symbols with llm need in a specific ref of the target repository.
 
         Args:
             ref (str): The reference of the target repository.
             symbol (str): The symbol to locates.
+            top_k (int, optional): The maximum number of similar symbols. Defaults to 5.
 
         Returns:
-            List[Tuple[str, int]] : File path and code lines for the most similar symbol.
+            List[Tuple[str, List[Tuple[str, int]]]]: Similar symbols, nearest first, with their file paths and code lines.
+        """
+        sha = self._resolve_ref(ref)
+        with self.prepare_lock:
+            if not self.symbol_index.has_ref(sha):
+                self._prepare(sha)
+        with self.fuzzy_index_lock:
+            if sha not in self.fuzzy_indexes:
+                self.fuzzy_indexes[sha] = FuzzyIndex(self.symbol_index.symbols(sha))
+        similar_symbols = self.fuzzy_indexes[sha].search(symbol, top_k)
+
+        return [
+            (symbol_i, self.symbol_index.lookup(sha, symbol_i))
+            for _, symbol_i in similar_symbols
+        ]
+
+    def _merge_base(self) -> str | None:
+        """
+        Get the merge base of the target release and the parent of the new patch, computed once per job.
+        """
+        with self.history_lock:
+            if "merge_base" not in self.history:
+                merge_base = self.repo.merge_base(
+                    self.target_release, self.new_patch_parent
+                )
+                self.history["merge_base"] = (
+                    merge_base[0].hexsha if merge_base else None
+                )
+            return self.history["merge_base"]
+
+    def _log_lines(self, filepath: str, start_line: int, end_line: int) -> str:
+        """
+        Run `git log -L` for a range of lines between the merge base and the parent of the new patch.
+        The output is cached on disk, keyed by the range, the file and both commits.
+        """
+        start_commit = self._merge_base()
+        key = f"{start_commit}..{self.new_patch_parent}:{start_line},{end_line}:{filepath}"
+        cache_file = os.path.join(
+            self.cache_dir, "history", hashlib.sha256(key.encode()).hexdigest()
+        )
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                return f.read()
+
+        log_message = self.repo.git.log(
+            "--oneline",
+            f"-L {start_line},{end_line}:{filepath}",
+            f"{start_commit}..{self.new_patch_parent}",
+        )
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="w", dir=os.path.dirname(cache_file), delete=False
+        ) as f:
+            f.write(log_message)
+        os.replace(f.name, cache_file)
+        return log_message
+
+    def _hunk_history(self, hunk: str) -> Future:
         """
-        # XXX: Analyzing ctags file everytime locate symbol is time-consuming.
-        symbols = self.symbol_map.get(ref, {})
-        most_similar = None
-        smallest_distance = float("inf")
+        Get the `git log -L` output for the lines changed by a hunk, computed by the background worker.
 
-        for symbol_i in symbols.keys():
-            # 计算 Levenshtein 距离
-            distance = Levenshtein.distance(symbol, symbol_i)
-            if distance < smallest_distance:
-                smallest_distance = distance
-                most_similar = symbol_i
+        Args:
+            hunk (str): A hunk of the new patch.
 
-        return symbols.get(most_similar), most_similar
+        Returns:
+            Future: Resolves to the log message.
+        """
+        filepath = re.findall(r"--- a/(.*)", hunk)[0]
+        chunks = re.findall(r"@@ -(\d+),(\d+) \+(\d+),(\d+) @@(.*)", hunk)[0]
+        start_line = int(chunks[0])
+        end_line = int(chunks[0]) + int(chunks[1]) - 1
+        with self.history_lock:
+            key = (filepath, start_line, end_line)
+            if key not in self.history:
+                self.history[key] = self.history_worker.submit(
+                    self._log_lines, filepath, start_line, end_line
+                )
+            return self.history[key]
+
+    def prefetch_history(self, hunks: List[str]) -> None:
+        """
+        Start computing the git history of every hunk in the background, so `git_history` returns instantly.
+
+        Args:
+            hunks (List[str]): The hunks of the new patch.
+        """
+        for hunk in hunks:
+            try:
+                self._hunk_history(hunk)
+            except IndexError:
+                continue
 
     def _git_history(self) -> str:
         """
@@ -186,20 +544,7 @@ class Project:
             XXX(str):
         """
         if self.now_hunk != "completed":
-            merge_base = self.repo.merge_base(
-                self.target_release, self.new_patch_parent
-            )
-            start_commit = merge_base[0].hexsha if merge_base else None
-            hunk = self.now_hunk
-            filepath = re.findall(r"--- a/(.*)", hunk)[0]
-            chunks = re.findall(r"@@ -(\d+),(\d+) \+(\d+),(\d+) @@(.*)", hunk)[0]
-            start_line = chunks[0]
-            end_line = int(chunks[0]) + int(chunks[1]) - 1
-            log_message = self.repo.git.log(
-                "--oneline",
-                f"-L {start_line},{end_line}:{filepath}",
-                f"{start_commit}..{self.new_patch_parent}",
-            )
+            log_message = self._hunk_history(self.now_hunk).result()
             # save each hunk related refs
             if self.now_hunk_num not in self.hunk_log_info and log_message:
                 last_context = list(utils.split_patch(log_message, False))[-1]
@@ -244,7 +589,8 @@ class Project:
             # XXX maybe too much context will confuse LLM, how could we refine it.
             ref_line = self.hunk_log_info[self.now_hunk_num][-1]
             ref = ref_line.split(" ")[0].strip()
-            log = self.repo.git.show(f"{ref}")
+            # one process for both the stat and the patch
+            log = self.repo.git.show("--stat", "--patch", f"{ref}")
             pps = utils.split_patch(log, False)
             dist = float("inf")
             last_context_len = len(self.last_context)
@@ -273,7 +619,11 @@ class Project:
                     continue
 
             ret = ""
-            stat = self.repo.git.show("--stat", f"{ref}")
+            stat = log.split("\ndiff --git ", 1)[0].rstrip("\n")
+            # with --patch, git separates the message from the stat with "---"
+            message, separator, diffstat = stat.rpartition("\n---\n")
+            if separator:
+                stat = f"{message}\n\n{diffstat}"
             ret += stat[0 : min(len(stat), 3000)]
             ret += "\n"
             if self.add_percent < 0.6:
@@ -311,30 +661,23 @@ class Project:
         contexts, num_context, _, _ = utils.extract_context(revised_patch_line)
         lineno = -1
         lines = []
-        min_distance = float("inf")
 
         try:
-            file = self.repo.tree(ref) / path
-            content = file.data_stream.read().decode("utf-8", errors="ignore")
-            lines = content.split("\n")
+            lines = self._read_lines(ref, path)
             lineno, dist = utils.find_most_similar_block(
                 contexts, lines, num_context, False
             )
         except:
-            similar_files = utils.find_most_similar_files(path.split("/")[-1], self.dir)
+            similar_files = self._find_similar_files(ref, path)
+            similar_lines = {}
             for similar_file in similar_files:
-                file = self.repo.tree(ref) / similar_file
-                content = file.data_stream.read().decode("utf-8", errors="ignore")
-                similar_lines = content.split("\n")
-                current_line, current_dist = utils.find_most_similar_block(
-                    "\n".join(contexts), similar_lines, num_context, False
-                )
-
-                if current_dist < min_distance:
-                    min_distance = current_dist
-                    lineno = current_line
-                    path = similar_file
-                    lines = similar_lines
+                similar_lines[similar_file] = self._read_lines(ref, similar_file)
+            similar_file, lineno, _ = utils.find_most_similar_block_in_files(
+                contexts, similar_lines, num_context
+            )
+            if similar_file:
+                path = similar_file
+                lines = similar_lines[similar_file]
 
         startline = max(lineno - 1, 0)
         endline = min(lineno + num_context, len(lines))
@@ -409,19 +752,21 @@ class Project:
                     logger.debug(
                         f"No {missing_file_path} and no {symbol_name} in the repo."
                     )
-                    file_paths = utils.find_most_similar_files(
-                        missing_file_path.split("/")[-1], self.dir
-                    )
+                    file_paths = self._find_similar_files(ref, missing_file_path)
                 else:
                     logger.debug(f"Find {symbol_name} in {symbol_locations}.")
                     file_paths = [item[0] for item in symbol_locations]
             except:
                 logger.debug("Can not find a symbol in given patch.")
-                file_paths = utils.find_most_similar_files(
-                    missing_file_path.split("/")[-1], self.dir
-                )
-
-        # try to apply patch to the target files
+                file_paths = self._find_similar_files(ref, missing_file_path)
+
+        # try to apply patch to the target files, skipping paths that do not exist in ref
+        sha = self._resolve_ref(ref)
+        file_paths = [
+            file_path
+            for file_path in file_paths
+            if self.objects.info(f"{sha}:{file_path}") is not None
+        ]
         for file_path in file_paths:
             new_patch = old_patch.replace(missing_file_path, file_path)
             logger.debug(f"Try to apply patch to {file_path}.")
@@ -452,22 +797,30 @@ class Project:
 
         """
         ret = ""
-        self._checkout(ref)
-        self.repo.git.reset("--hard")
         if revise_context:
             logger.debug("original patch:\n" + patch)
-        revised_patch, fixed = utils.revise_patch(patch, self.dir, revise_context)
+        revised_patch, fixed = utils.revise_patch(
+            patch,
+            self.dir,
+            revise_context,
+            lambda path: self._read_lines(ref, path, splitlines=True),
+        )
         with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
             f.write(revised_patch)
         logger.debug("revised patch:\n" + revised_patch)
         logger.debug(f"Applying patch {f.name}")
         try:
-            self.repo.git.apply([f.name], v=True)
+            # check the patch against the blobs of ref in a private index, the working tree is never touched
+            self.repo.git.apply(
+                ["--cached", "--check", f.name],
+                v=True,
+                env={"GIT_INDEX_FILE": self._get_index_file(ref)},
+            )
             ret += "Patch applied successfully\n"
             self.succeeded_patches.append(revised_patch)
             self.round_succeeded = True
         except Exception as e:
-            if "No such file" in e.stderr:
+            if "No such file" in e.stderr or "does not exist in index" in e.stderr:
                 logger.debug(f"File not found")
                 find_ret = self._apply_file_move_handling(ref, revised_patch)
                 ret += find_ret
@@ -482,7 +835,274 @@ class Project:
                 ret += "Besides, here is detailed info about how the context differs between the patch and the old version.\n"
                 ret += differ
 
-        self.repo.git.reset("--hard")
+        return ret
+
+    def _prebuild_command(self, complete_patch: str) -> str | None:
+        """
+        Work out a command compiling only the object files of the C sources changed by the patch.
+
+        Kbuild trees configured in the working directory or in `$BUILD_DIR` build
+        `path/to/file.o` if `prebuild_make_args` gives the make variables build.sh uses, Ninja trees
+        (e.g. CMake) build `path/to/file.c^`, and other trees with a `compile_commands.json` or
+        Kbuild `.cmd` files rerun the recorded compiler commands.
+
+        Args:
+            complete_patch (str): The complete patch applied to the working directory.
+
+        Returns:
+            str | None: The bash command, or None if the targets could not be worked out.
+        """
+        sources = sorted(
+            {
+                path
+                for path in utils.patched_files(complete_patch)
+                if path.endswith(".c")
+                and os.path.exists(os.path.join(self.work_dir, path))
+            }
+        )
+        if not sources:
+            return None
+        build_dir = self.builder.build_dir(self.work_dir)
+        objects = " ".join(shlex.quote(f"{path[:-2]}.o") for path in sources)
+        # without the ARCH=, CROSS_COMPILE=... of build.sh make would reconfigure the tree
+        # for the host, the recorded commands below are used instead
+        if self.prebuild_make_args is not None:
+            if os.path.exists(os.path.join(self.work_dir, ".config")):
+                return f"make {self.prebuild_make_args} -j$(nproc) {objects}"
+            if os.path.exists(os.path.join(build_dir, ".config")):
+                return f'make O="$BUILD_DIR" {self.prebuild_make_args} -j$(nproc) {objects}'
+
+        for directory in (build_dir, os.path.join(self.work_dir, "build")):
+            if os.path.exists(os.path.join(directory, "build.ninja")):
+                targets = " ".join(
+                    shlex.quote(f"{os.path.join(self.work_dir, path)}^")
+                    for path in sources
+                )
+                return f"ninja -C {shlex.quote(directory)} {targets}"
+        commands = []
+        for path in sources:
+            compile_command = self._compile_command(path)
+            if compile_command is None:
+                # a source the build does not know yet, only the full build can tell
+                return None
+            directory, command = compile_command
+            commands.append(f"(cd {shlex.quote(directory)} && {command})")
+        return " && ".join(commands)
+
+    def _compile_commands(self, json_file: str) -> Dict[str, Tuple[str, str]]:
+        try:
+            mtime = os.path.getmtime(json_file)
+        except OSError:
+            return {}
+        cached = self.compile_commands.get(json_file)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        commands = {}
+        try:
+            with open(json_file) as f:
+                for entry in json.load(f):
+                    file = os.path.join(entry["directory"], entry["file"])
+                    command = entry.get("command") or shlex.join(entry["arguments"])
+                    commands.setdefault(
+                        os.path.normpath(file), (entry["directory"], command)
+                    )
+        except (OSError, json.JSONDecodeError, KeyError):
+            pass
+        self.compile_commands[json_file] = (mtime, commands)
+        return commands
+
+    def _compile_command(self, path: str) -> Tuple[str, str] | None:
+        """
+        Look up the compiler command an earlier build used for a source file.
+
+        `compile_commands.json` in `$BUILD_DIR`, `build/` or the working directory is searched
+        first, then the `.file.o.cmd` files Kbuild leaves next to its object files.
+
+        Args:
+            path (str): The source file, relative to the working directory.
+
+        Returns:
+            Tuple[str, str] | None: The directory to run the command in and the command.
+        """
+        build_dir = self.builder.build_dir(self.work_dir)
+        file = os.path.join(self.work_dir, path)
+        for directory in (
+            build_dir,
+            os.path.join(self.work_dir, "build"),
+            self.work_dir,
+        ):
+            commands = self._compile_commands(
+                os.path.join(directory, "compile_commands.json")
+            )
+            if file in commands:
+                return commands[file]
+
+        directory, name = os.path.split(path)
+        cmd_file = f".{os.path.splitext(name)[0]}.o.cmd"
+        for root in (self.work_dir, build_dir):
+            try:
+                with open(os.path.join(root, directory, cmd_file)) as f:
+                    for line in f:
+                        if match := re.match(r"(?:saved)?cmd_\S+ := (.*)", line):
+                            return root, match[1]
+            except OSError:
+                continue
+        return None
+
+    def _syntax_errors(self, path: str) -> List[Tuple[str, List[int], str]]:
+        """
+        Check the syntax of a patched file, with `-fsyntax-only` and the compiler flags of an
+        earlier build if there are any, or else by checking that its brackets are balanced.
+
+        Args:
+            path (str): The file, relative to the working directory.
+
+        Returns:
+            List[Tuple[str, List[int], str]]: (file, lines, message) of each error, the lines
+                where it may be, e.g. both ends of mismatched brackets.
+        """
+        compile_command = self._compile_command(path)
+        if compile_command is not None:
+            directory, command = compile_command
+            process = self.builder.popen(syntax.syntax_only_command(command), directory)
+            try:
+                _, output, _ = builder.stream_output(process, 60)
+            except subprocess.TimeoutExpired:
+                self.builder.kill(process)
+                self.inconclusive = True
+                output = ""
+            errors = []
+            for match in syntax.ERROR_LINE.finditer(output):
+                file = os.path.normpath(os.path.join(directory, match["file"]))
+                errors.append(
+                    (
+                        os.path.relpath(file, self.work_dir),
+                        [int(match["line"])],
+                        match["message"],
+                    )
+                )
+            # no errors from a failed run means the compiler or the flags are unusable
+            if errors or process.returncode == 0:
+                return errors
+
+        with open(os.path.join(self.work_dir, path), errors="replace") as f:
+            error = syntax.check_balance(f.read())
+        if error is None:
+            return []
+        try:
+            original = self.work_repo.git.show(f"HEAD:{path}")
+        except:
+            original = ""
+        if syntax.check_balance(original) is not None:
+            # e.g. braces split across #ifdef branches, the check can not tell anything
+            return []
+        return [(path, *error)]
+
+    def _check_syntax(self, complete_patch: str) -> str:
+        """
+        Check the syntax of every C file changed by the applied patch, before the much slower build.
+
+        Args:
+            complete_patch (str): The complete patch applied to the working directory.
+
+        Returns:
+            str: Feedback about the syntax errors, or an empty string if there are none.
+        """
+        errors = []
+        for path in utils.patched_files(complete_patch):
+            if path.endswith(syntax.C_SUFFIXES) and os.path.exists(
+                os.path.join(self.work_dir, path)
+            ):
+                errors += self._syntax_errors(path)
+        if not errors:
+            return ""
+
+        logger.info(f"Syntax check                      FAILED")
+        error_lines = []
+        for path, lines, message in errors[: max(self.max_build_errors, 1)]:
+            line = lines[0]
+            location = "it is not a line of the patch"
+            if os.path.exists(os.path.join(self.work_dir, path)):
+                line_map = utils.map_patch_lines(
+                    complete_patch,
+                    path,
+                    utils.read_file_lines(os.path.join(self.work_dir, path)),
+                )
+                # report the line the patch is responsible for, an added one if any
+                patch_lines = complete_patch.splitlines()
+                patched = sorted(
+                    (candidate for candidate in lines if candidate in line_map),
+                    key=lambda candidate: not patch_lines[
+                        line_map[candidate] - 1
+                    ].startswith("+"),
+                )
+                if patched:
+                    line = patched[0]
+                    location = f"line {line_map[line]} of the patch"
+            error_lines.append(f"{path}:{line}: error: {message} ({location})")
+        error_lines = "\n".join(error_lines)
+        logger.debug(error_lines)
+        ret = "The patched source code has SYNTAX errors, so I did not even try to compile it. "
+        ret += f"Here are the errors, with the lines of your patch they come from:\n{error_lines}\n"
+        ret += "Please check the brackets, the `->` operators and anything else that may have been garbled in these lines, and revise the patch. "
+        ret += "Please DO NOT send the same patch to me, repeated patches will harm the lives of others.\n"
+        self.work_repo.git.reset("--hard")
+        return ret
+
+    def _run_build(self, command: str) -> Tuple[bool, str]:
+        """
+        Run a build command in the working directory, stopping it after `max_build_errors` compiler errors.
+
+        Args:
+            command (str): The bash command to run.
+
+        Returns:
+            Tuple[bool, str]: Whether the build succeeded, and its stderr.
+
+        Raises:
+            subprocess.TimeoutExpired: If the build does not finish within an hour.
+        """
+        build_process = self.builder.popen(command, self.work_dir)
+        error_count = 0
+
+        def too_many_errors(stream: str, line: str) -> bool:
+            nonlocal error_count
+            if stream == "stderr" and "error:" in line.lower():
+                error_count += 1
+            return 0 < self.max_build_errors <= error_count
+
+        try:
+            _, compile_result, stopped = builder.stream_output(
+                build_process, 60 * 60, too_many_errors
+            )
+        except subprocess.TimeoutExpired:
+            self.builder.kill(build_process)
+            raise
+
+        if stopped:
+            # the errors seen so far are feedback enough, do not wait for the rest of the build
+            logger.debug(f"Stop the build after {error_count} errors.")
+            self.builder.kill(build_process)
+        return not stopped and build_process.returncode == 0, compile_result
+
+    def _compile_failure(self, compile_result: str, hunks: List[str]) -> str:
+        logger.info(f"Compilation                       FAILED")
+        error_lines = diagnostics.summarize(
+            compile_result, hunks, self.work_dir, self.feedback_tokens
+        )
+        logger.debug(error_lines)
+        located, others = diagnostics.parse_diagnostics(compile_result, self.work_dir)
+        if not located and not any("undefined reference" in line for line in others):
+            # no compiler error to blame the patch for, the build may have been killed,
+            # run out of disk or lacked a tool
+            self.inconclusive = True
+        ret = "The source code could not be COMPILED successfully after applying the patch. "
+        ret += "Next I'll give you the error message during compiling, and you should modify the error patch. "
+        ret += f"Here is the error message:\n{error_lines}\n"
+        ret += "Please revise the patch with above error message. "
+        ret += "Or use tools `locate_symbol` and `viewcode` to re-check patch-related code snippet. "
+        ret += "Please DO NOT send the same patch to me, repeated patches will harm the lives of others.\n"
+        self.work_repo.git.reset("--hard")
         return ret
 
     def _compile_patch(
@@ -499,7 +1119,7 @@ class Project:
             str: A message indicating the result of the compilation process.
 
         Raises:
-            subprocess.TimeoutExpired: If the compilation process times out.
+            BuildTimeout: If the compilation process times out.
 
         """
         # apply joined patch
@@ -509,13 +1129,15 @@ class Project:
             f.write(complete_patch)
             logger.debug(f"The completed patch file {f.name}")
         pps = utils.split_patch(complete_patch, False)
+        applied_hunks = []
         for idx, pp in enumerate(pps):
-            revised_patch, fixed = utils.revise_patch(pp, self.dir, revise_context)
+            revised_patch, fixed = utils.revise_patch(pp, self.work_dir, revise_context)
+            applied_hunks.append(revised_patch)
             with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
                 f.write(revised_patch)
             try:
                 # XXX 这里应该把修正后的patch加到结果里面
-                self.repo.git.apply([f.name], v=True)
+                self.work_repo.git.apply([f.name], v=True)
                 logger.debug(
                     f"The joined patch hunk {idx} could be applied successfully, file {f.name}"
                 )
@@ -531,93 +1153,84 @@ class Project:
                 ret += f"In addition to that, I've got more detailed error messages for you below where the context of your generated patch differs specifically from the source code context.(The line numbers below are all line numbers in the hunk, not the entire patch.)\n"
                 ret += differ
                 ret += f"Based on the above feedback, MUST you please modify only hunk {idx} in the patch and leave the other hunks untouched so that the context present in hunk {idx} is exactly the same as the source code to guarantee that git apply can be executed normally.\n"
-                self.repo.git.reset("--hard")
+                self.work_repo.git.reset("--hard")
                 return ret
 
         # compile the patch
         logger.debug("Start compile the patched source code")
-        if not os.path.exists(os.path.join(self.dir, "build.sh")):
+        if not os.path.exists(os.path.join(self.work_dir, "build.sh")):
             logger.debug("No build.sh file found.")
             ret += "The patched source code could be COMPILED successfully! I really thank you for your great efforts.\n"
             self.compile_succeeded = True
             return ret
 
-        # build_process = subprocess.Popen(
-        #     ["/bin/bash", "build.sh"],
-        #     stdin=subprocess.DEVNULL,
-        #     stdout=subprocess.PIPE,
-        #     stderr=subprocess.PIPE,
-        #     cwd=self.dir,
-        #     text=True,
-        # )
-        docker_command = [
-            "docker",
-            "run",
-            "-v",
-            f"{self.dir}:{self.dir}",
-            "--rm",
-            "build-kernel-ubuntu-16.04",
-            "/bin/bash",
-            "-c",
-            f"cd {self.dir}; bash build.sh",
-        ]
-        build_process = subprocess.Popen(
-            docker_command,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self.dir,
-            text=True,
-        )
+        if self.syntax_check:
+            with utils.timed(self.stage_times, "syntax"):
+                syntax_errors = self._check_syntax(complete_patch)
+            if syntax_errors:
+                return ret + syntax_errors
+
         try:
-            _, compile_result = build_process.communicate(timeout=60 * 60)
+            command = self._prebuild_command(complete_patch) if self.prebuild else None
+            if command:
+                logger.debug(f"Pre-build the objects touched by the patch: {command}")
+                with utils.timed(self.stage_times, "prebuild"):
+                    succeeded, compile_result = self._run_build(command)
+                # a pre-build broken for other reasons than the patch leaves no compiler errors
+                if not succeeded and "error:" in compile_result.lower():
+                    return ret + self._compile_failure(compile_result, applied_hunks)
+            succeeded, compile_result = self._run_build("bash build.sh")
         except subprocess.TimeoutExpired:
-            build_process.kill()
-            ret += f"The compilation process of the patched source code is timeout. "
-            self.repo.git.reset("--hard")
+            self.work_repo.git.reset("--hard")
             logger.warning(
                 "Timeout in project compilation. Please check patch manually!"
             )
             for patch in self.succeeded_patches:
                 logger.info(patch)
-            exit(0)
-            return ret
+            # exiting here would take down the event loop thread running the job
+            raise BuildTimeout("The compilation of the patched source code timed out")
 
-        if build_process.returncode != 0:
-            logger.info(f"Compilation                       FAILED")
-            error_lines = "\n".join(
-                [
-                    line
-                    for line in compile_result.splitlines()
-                    if "error:" in line.lower()
-                ]
-            )
-            logger.debug(error_lines)
-            ret += "The source code could not be COMPILED successfully after applying the patch. "
-            ret += "Next I'll give you the error message during compiling, and you should modify the error patch. "
-            ret += f"Here is the error message:\n{error_lines}\n"
-            ret += "Please revise the patch with above error message. "
-            ret += "Or use tools `locate_symbol` and `viewcode` to re-check patch-related code snippet. "
-            ret += "Please DO NOT send the same patch to me, repeated patches will harm the lives of others.\n"
-            self.repo.git.reset("--hard")
+        if not succeeded:
+            ret += self._compile_failure(compile_result, applied_hunks)
         else:
             logger.info(f"Compilation                       PASS")
             ret += "The patched source code could be COMPILED successfully! I really thank you for your great efforts.\n"
             self.compile_succeeded = True
-        # self.repo.git.reset("--hard")
+        # self.work_repo.git.reset("--hard")
         return ret
 
-    def _run_testcase(self) -> str:
+    def _save_log(self, stage: str, log: str) -> str:
+        """
+        Keep the full output of a failed testcase or PoC run, only a reduced version is fed back.
+
+        Returns:
+            str: The path of the log file.
+        """
+        os.makedirs(self.log_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="w",
+            prefix=f"{self.log_prefix}-{stage}-",
+            suffix=".log",
+            dir=self.log_dir,
+            delete=False,
+        ) as f:
+            f.write(log)
+        return f.name
+
+    def _run_testcase(self, complete_patch: str) -> str:
         """
         Runs the testcase after compiling a patch.
 
+        Args:
+            complete_patch (str): The complete patch, its files decide which sanitizer frames are kept.
+
         Returns:
             str: A message indicating the result of the testcase process.
         """
         ret = ""
         logger.debug("Run testcase after compile")
 
-        if not os.path.exists(os.path.join(self.dir, "test.sh")):
+        if not os.path.exists(os.path.join(self.work_dir, "test.sh")):
             logger.debug("No test.sh file found, considered as test passed.")
             self.testcase_succeeded = True
             ret += "The patched source code could pass TESTCASE! I really thank you for your great efforts.\n"
@@ -627,19 +1240,31 @@ class Project:
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            cwd=self.dir,
+            cwd=self.work_dir,
             text=True,
         )
 
         try:
-            _, testcase_result = testcase_process.communicate(timeout=60 * 30)
+            testcase_output, testcase_result, _ = builder.stream_output(
+                testcase_process, 60 * 30
+            )
         except subprocess.TimeoutExpired:
             testcase_process.kill()
+            self.inconclusive = True
             ret += "The TESTCASE process of the patched source code is timeout. "
             return ret
 
         if testcase_process.returncode != 0:
             logger.info(f"Testsuite                         FAILED")
+            # test runners report failed tests on stdout
+            testcase_result = testcase_output + testcase_result
+            log_file = self._save_log("testcase", testcase_result)
+            logger.debug(f"Full testcase output in {log_file}")
+            testcase_result = log_reducer.reduce_log(
+                testcase_result,
+                utils.patched_files(complete_patch),
+                self.feedback_tokens,
+            )
             logger.debug(f"{testcase_result}")
             ret = "The patched program could not pass the testcase. "
             ret += "Next I'll give you the error message during running the testcase, and you should modify the previous error patch according to this section. "
@@ -664,7 +1289,7 @@ class Project:
         ret = ""
         logger.debug("Run PoC after compile and run testcase")
 
-        if not os.path.exists(os.path.join(self.dir, "poc.sh")):
+        if not os.path.exists(os.path.join(self.work_dir, "poc.sh")):
             logger.debug("No poc.sh file found, considered as PoC passed.")
             self.poc_succeeded = True
             self.succeeded_patches.clear()
@@ -676,20 +1301,29 @@ class Project:
             stdin=subprocess.DEVNULL,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            cwd=self.dir,
+            cwd=self.work_dir,
             text=True,
         )
 
         try:
-            _, poc_result = poc_process.communicate(timeout=60 * 10)
+            _, poc_result, _ = builder.stream_output(poc_process, 60 * 10)
         except subprocess.TimeoutExpired:
             poc_process.kill()
+            self.inconclusive = True
             ret += "The TESTCASE process of the patched source code is timeout. "
             return ret
 
         if self.err_msg in poc_result:
             logger.info(f"PoC test                          FAILED")
             logger.debug(f"returncode = {poc_process.returncode}")
+            log_file = self._save_log("poc", poc_result)
+            logger.debug(f"Full PoC output in {log_file}")
+            poc_result = log_reducer.reduce_log(
+                poc_result,
+                utils.patched_files(complete_patch),
+                self.feedback_tokens,
+                (self.err_msg,),
+            )
             logger.debug(f"stderr: {poc_result}")
             ret += "Existing PoC could still trigger the bug, which means your patch fail to fix the bug. "
             ret += "Next I'll give you the error message during running the PoC, and you should modify the previous error patch according to this section. "
@@ -707,6 +1341,105 @@ class Project:
             self.poc_succeeded = True
         return ret
 
+    def _validation_key(self, ref: str, patch: str) -> str:
+        """
+        Hash everything a validation result depends on: the target commit, the patch revised like
+        `_compile_patch` does with trailing whitespace stripped, the build/test/PoC scripts,
+        the build configuration, the expected PoC error and the state validation starts from.
+        """
+        revise_context = self.context_mismatch_times >= 1
+        try:
+            sha = self._resolve_ref(ref)
+            hunks = [
+                utils.revise_patch(
+                    pp,
+                    self.dir,
+                    revise_context,
+                    lambda path: self._read_lines(sha, path, splitlines=True),
+                )[0]
+                for pp in utils.split_patch(patch, False)
+            ]
+        except:
+            sha, hunks = ref, [patch]
+        normalized = "\n".join(
+            line.rstrip() for hunk in hunks for line in hunk.strip().splitlines()
+        )
+
+        digest = hashlib.sha256()
+        for part in (
+            sha,
+            normalized,
+            self.err_msg,
+            str(revise_context),
+            str((self.compile_succeeded, self.testcase_succeeded, self.poc_succeeded)),
+            str(
+                (
+                    self.builder.mode,
+                    self.builder.image,
+                    self.prebuild,
+                    self.prebuild_make_args,
+                    self.syntax_check,
+                    self.max_build_errors,
+                    self.feedback_tokens,
+                )
+            ),
+        ):
+            digest.update(hashlib.sha256(part.encode()).digest())
+        for script in DATASET_SCRIPTS:
+            script_path = os.path.join(self.patch_dataset_dir, script)
+            if os.path.exists(script_path):
+                with open(script_path, "rb") as f:
+                    digest.update(hashlib.sha256(f.read()).digest())
+            else:
+                digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _replay_validation(self, key: str, patch: str) -> str | None:
+        """
+        Restore the outcome of an identical earlier validation, if any.
+
+        Returns:
+            str | None: The feedback of the earlier validation.
+        """
+        cache_file = os.path.join(self.cache_dir, "validation", f"{key}.json")
+        try:
+            with open(cache_file, "r") as f:
+                cached = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        logger.info(f"Validation                        REUSED")
+        if not self.compile_succeeded:
+            self.context_mismatch_times += 1
+        (
+            self.compile_succeeded,
+            self.testcase_succeeded,
+            self.poc_succeeded,
+        ) = cached["flags"]
+        if self.poc_succeeded:
+            self.succeeded_patches.clear()
+            self.succeeded_patches.append(patch)
+        return cached["feedback"]
+
+    def _store_validation(self, key: str, feedback: str) -> None:
+        cache_file = os.path.join(self.cache_dir, "validation", f"{key}.json")
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            mode="w", dir=os.path.dirname(cache_file), delete=False
+        ) as f:
+            json.dump(
+                {
+                    "flags": (
+                        self.compile_succeeded,
+                        self.testcase_succeeded,
+                        self.poc_succeeded,
+                    ),
+                    "feedback": feedback,
+                },
+                f,
+            )
+        os.replace(f.name, cache_file)
+
     def _validate(self, ref: str, patch: str) -> str:
         """
         Validates a patch by using the `_compile_patch`, `_run_testcase`, and `_run_poc` methods.
@@ -718,73 +1451,117 @@ class Project:
         Returns:
             str: The validation result.
 
+        Raises:
+            BuildTimeout: If the compilation of the complete patch times out.
+
         """
         if self.all_hunks_applied_succeeded:
+            if self.validation_cache:
+                key = self._validation_key(ref, patch)
+                if cached := self._replay_validation(key, patch):
+                    return cached
+
             ret = ""
+            self.inconclusive = False
             if not self.compile_succeeded:
-                ret += self._compile_patch(
-                    ref, patch, True if self.context_mismatch_times >= 1 else False
-                )
+                with utils.timed(self.stage_times, "compile"):
+                    ret += self._compile_patch(
+                        ref, patch, True if self.context_mismatch_times >= 1 else False
+                    )
                 self.context_mismatch_times += 1
             if self.compile_succeeded and not self.testcase_succeeded:
-                ret += self._run_testcase()
+                with utils.timed(self.stage_times, "testcase"):
+                    ret += self._run_testcase(patch)
             if (
                 self.compile_succeeded
                 and self.testcase_succeeded
                 and not self.poc_succeeded
             ):
-                ret += self._run_poc(patch)
+                with utils.timed(self.stage_times, "poc"):
+                    ret += self._run_poc(patch)
+            # e.g. a timeout, run it again next time
+            if self.validation_cache and not self.inconclusive:
+                self._store_validation(key, ret)
             return ret
         else:
             if "need not ported" in patch:
                 self.round_succeeded = True
                 return "Patch applied successfully\n"
 
-            ret = self._apply_hunk(
-                ref, patch, True if self.context_mismatch_times >= 2 else False
-            )
+            with utils.timed(self.stage_times, "apply"):
+                ret = self._apply_hunk(
+                    ref, patch, True if self.context_mismatch_times >= 2 else False
+                )
             if "CONTEXT MISMATCH" in ret:
                 self.context_mismatch_times += 1
             return ret
 
+    def _memo_ref(self, ref: str) -> str | None:
+        try:
+            return self._resolve_ref(ref)
+        except:
+            # invalid refs are reported by the tool itself, never memoized
+            return None
+
     def get_tools(self):
+        # read-only tools of one agent session share their memoized results
+        memo = ToolMemo()
         return (
-            creat_viewcode_tool(self),
-            creat_locate_symbol_tool(self),
+            creat_viewcode_tool(self, memo),
+            creat_locate_symbol_tool(self, memo),
             create_validate_tool(self),
-            create_git_history_tool(self),
-            create_git_show_tool(self),
+            create_git_history_tool(self, memo),
+            create_git_show_tool(self, memo),
         )
 
 
-def creat_locate_symbol_tool(project: Project):
-    @tool
-    def locate_symbol(ref: str, symbol: str) -> str:
-        """
-        Locate a symbol in a specific ref of the target repository.
-        """
+def creat_locate_symbol_tool(project: Project, memo: ToolMemo | None = None):
+    def _locate_symbol(ref: str, symbol: str) -> str:
         res = project._locate_symbol(ref, symbol)
         if res is not None:
             return "\n".join([f"{file}:{line}" for file, line in res])
         else:
-            res, most_similar = project._locate_similar_symbol(ref, symbol)
+            similar_symbols = project._locate_similar_symbol(ref, symbol)
             ret = f"The symbol {symbol} you are looking for does not exist in the current ref.\n"
-            ret += f"But here is a symbol similar to it. It's `{most_similar}`.\n"
-            ret += f"The file where this symbol is located is: \n"
-            ret += "\n".join([f"{file}:{line}" for file, line in res])
-            ret += f"\nPlease be careful to check that this symbol indicates the same thing as the previous symbol.\n"
+            if not similar_symbols:
+                ret += "And there is no symbol similar to it, please check the symbol name.\n"
+                return ret
+            ret += f"But here are symbols similar to it, the most similar first.\n"
+            for most_similar, res in similar_symbols:
+                ret += f"The file where symbol `{most_similar}` is located is: \n"
+                ret += "\n".join([f"{file}:{line}" for file, line in res])
+                ret += "\n"
+            ret += f"Please be careful to check that these symbols indicate the same thing as the previous symbol.\n"
             return ret
 
+    @tool
+    def locate_symbol(ref: str, symbol: str) -> str:
+        """
+        Locate a symbol in a specific ref of the target repository.
+        """
+        sha = project._memo_ref(ref)
+        if memo is None or sha is None:
+            return _locate_symbol(ref, symbol)
+        return memo.get(
+            ("locate_symbol", sha, symbol), lambda: _locate_symbol(ref, symbol)
+        )
+
     return locate_symbol
 
 
-def creat_viewcode_tool(project: Project):
+def creat_viewcode_tool(project: Project, memo: ToolMemo | None = None):
     @tool
     def viewcode(ref: str, path: str, startline: int, endline: int) -> str:
         """
         View a file from a specific ref of the target repository. Lines between startline and endline are shown.
         """
-        return project._viewcode(ref, path, startline, endline)
+        sha = project._memo_ref(ref)
+        if memo is None or sha is None:
+            return project._viewcode(ref, path, startline, endline)
+        return memo.get(
+            ("viewcode", sha, path, startline, endline),
+            lambda: project._viewcode(ref, path, startline, endline),
+        )
 
     return viewcode
 
@@ -800,23 +1577,33 @@ def create_validate_tool(project: Project):
     return validate
 
 
-def create_git_history_tool(project: Project):
+def create_git_history_tool(project: Project, memo: ToolMemo | None = None):
     @tool
     def git_history() -> str:
         """
         get history for lines which relate to patch hunk.
         """
-        return project._git_history()
+        if memo is None:
+            return project._git_history()
+        # commits are fixed for a job, the result only depends on the hunk
+        return memo.get(("git_history", project.now_hunk), project._git_history)
 
     return git_history
 
 
-def create_git_show_tool(project: Project):
+def create_git_show_tool(project: Project, memo: ToolMemo | None = None):
     @tool
     def git_show() -> str:
         """
         show change log for a specific ref
         """
-        return project._git_show()
+        if memo is None:
+            return project._git_show()
+        # the commit shown is the last one found by git_history for this hunk
+        refs = tuple(project.hunk_log_info.get(project.now_hunk_num, []))
+        return memo.get(
+            ("git_show", project.now_hunk, refs, project.add_percent),
+            project._git_show,
+        )
 
     return git_show
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Set, Tuple
+
+SCHEMA_VERSION = 2
+
+
+class SymbolIndex:
+    """
+    Persistent symbol store shared by every run and process on this machine.
+
+    Tags are stored per blob SHA, so a file content is only analyzed by ctags once.
+    Each indexed commit keeps its (path, blob) listing, which assembles the per-ref view.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=600, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.lock, self.conn:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                for table in ("refs", "symbols", "ref_files", "blobs", "blob_tags"):
+                    self.conn.execute(f"DROP TABLE IF EXISTS {table}")
+                self.conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS refs (sha TEXT PRIMARY KEY)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS ref_files "
+                "(sha TEXT NOT NULL, path TEXT NOT NULL, blob TEXT NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (blob TEXT PRIMARY KEY)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS blob_tags "
+                "(blob TEXT NOT NULL, symbol TEXT NOT NULL, lineno INTEGER NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ref_files_sha ON ref_files (sha)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS ref_files_blob ON ref_files (blob, sha)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS blob_tags_symbol ON blob_tags (symbol)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS blob_tags_blob ON blob_tags (blob)"
+            )
+
+    def has_ref(self, sha: str) -> bool:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM refs WHERE sha = ?", (sha,)
+            ).fetchone()
+        return row is not None
+
+    def missing_blobs(self, blobs: Iterable[str]) -> Set[str]:
+        """
+        Returns the blobs that have never been analyzed by ctags.
+        """
+        missing = set(blobs)
+        pending = list(missing)
+        with self.lock:
+            for i in range(0, len(pending), 500):
+                chunk = pending[i : i + 500]
+                rows = self.conn.execute(
+                    f"SELECT blob FROM blobs WHERE blob IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                missing.difference_update(row[0] for row in rows)
+        return missing
+
+    def add_blobs(
+        self, blobs: Iterable[str], tags: Dict[str, List[Tuple[str, int]]]
+    ) -> None:
+        """
+        Store the ctags entries of analyzed blobs. Blobs without any tag are recorded as well.
+
+        Args:
+            blobs (Iterable[str]): Every blob that has been analyzed.
+            tags (Dict[str, List[Tuple[str, int]]]): (symbol, lineno) tuples of each blob.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            for blob in blobs:
+                # another process may have analyzed the same blob meanwhile
+                if self.conn.execute(
+                    "INSERT OR IGNORE INTO blobs (blob) VALUES (?)", (blob,)
+                ).rowcount:
+                    self.conn.executemany(
+                        "INSERT INTO blob_tags (blob, symbol, lineno) VALUES (?, ?, ?)",
+                        (
+                            (blob, symbol, lineno)
+                            for symbol, lineno in tags.get(blob, [])
+                        ),
+                    )
+
+    def add_ref(self, sha: str, files: Iterable[Tuple[str, str]]) -> None:
+        """
+        Store the (path, blob) listing of a commit, which makes it searchable.
+
+        Args:
+            sha (str): The resolved commit SHA.
+            files (Iterable[Tuple[str, str]]): (path, blob) tuples of the commit tree.
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            if self.conn.execute("SELECT 1 FROM refs WHERE sha = ?", (sha,)).fetchone():
+                return
+            self.conn.executemany(
+                "INSERT INTO ref_files (sha, path, blob) VALUES (?, ?, ?)",
+                ((sha, path, blob) for path, blob in files),
+            )
+            self.conn.execute("INSERT INTO refs (sha) VALUES (?)", (sha,))
+
+    def lookup(self, sha: str, symbol: str) -> List[Tuple[str, int]] | None:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT ref_files.path, blob_tags.lineno FROM blob_tags "
+                "JOIN ref_files ON ref_files.blob = blob_tags.blob AND ref_files.sha = ? "
+                "WHERE blob_tags.symbol = ? ORDER BY ref_files.path, blob_tags.lineno",
+                (sha, symbol),
+            ).fetchall()
+        return [(file, lineno) for file, lineno in rows] or None
+
+    def symbols(self, sha: str) -> List[str]:
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT blob_tags.symbol FROM ref_files "
+                "JOIN blob_tags ON blob_tags.blob = ref_files.blob WHERE ref_files.sha = ?",
+                (sha,),
+            ).fetchall()
+        return [row[0] for row in rows]
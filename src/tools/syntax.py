@@ -0,0 +1,149 @@
+import re
+import shlex
+from typing import List, Tuple
+
+C_SUFFIXES = (".c", ".h", ".cc", ".cpp", ".cxx", ".hh", ".hpp")
+
+# file:line[:column]: [fatal ]error: message, as printed by gcc and clang
+ERROR_LINE = re.compile(
+    r"^(?P<file>[^:\s][^:]*):(?P<line>\d+):(?:\d+:)? (?:fatal )?error: (?P<message>.*)$",
+    re.M,
+)
+
+BRACKETS = {")": "(", "]": "[", "}": "{"}
+
+
+def check_balance(text: str) -> Tuple[List[int], str] | None:
+    """
+    Check that the parentheses, brackets and braces of C source code are balanced.
+
+    Comments, string and character literals and preprocessor directives are skipped, so
+    macros like `#define BEGIN {` do not count.
+
+    Args:
+        text (str): The source code.
+
+    Returns:
+        Tuple[List[int], str] | None: The lines and description of the first problem, or None if
+            balanced. A mismatched closer comes with the line of the opener it was matched
+            against, either one may be the line that is wrong. Openers never closed come with
+            the lines of braces closed by a `}` indented differently, which may have taken the
+            closer of another one, followed by the lines of all the unclosed ones, innermost first.
+    """
+    stack: List[Tuple[str, int, str]] = []
+    misindented: List[int] = []
+    line = 1
+    i = 0
+    line_start = True
+    while i < len(text):
+        char = text[i]
+        if char == "\n":
+            line += 1
+            line_start = True
+            i += 1
+            continue
+        if char in " \t\r\f\v":
+            i += 1
+            continue
+        if line_start and char == "#":
+            # skip the directive including its continuation lines
+            while i < len(text) and text[i] != "\n":
+                if text[i] == "\\" and text[i + 1 : i + 2] == "\n":
+                    line += 1
+                    i += 1
+                elif text.startswith("/*", i):
+                    end = text.find("*/", i + 2)
+                    end = len(text) if end < 0 else end
+                    line += text.count("\n", i, end)
+                    i = end + 1
+                i += 1
+            continue
+        line_start = False
+        if text.startswith("//", i):
+            while i < len(text) and text[i] != "\n":
+                if text[i] == "\\" and text[i + 1 : i + 2] == "\n":
+                    line += 1
+                    i += 1
+                i += 1
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            if end < 0:
+                return [line], "unterminated comment"
+            line += text.count("\n", i, end)
+            i = end + 2
+        elif char in "\"'":
+            start_line = line
+            i += 1
+            while i < len(text) and text[i] != char:
+                if text[i] == "\n":
+                    return [start_line], f"missing terminating {char} character"
+                if text[i] == "\\":
+                    if text[i + 1 : i + 2] == "\n":
+                        line += 1
+                    i += 1
+                i += 1
+            i += 1
+        elif char in "([{":
+            stack.append((char, line, _indent(text, i)))
+            i += 1
+        elif char in BRACKETS:
+            if not stack:
+                return [line], f"unmatched '{char}'"
+            opener, opener_line, opener_indent = stack.pop()
+            if opener != BRACKETS[char]:
+                return (
+                    [line, opener_line],
+                    f"'{char}' does not match the '{opener}' opened at line {opener_line}",
+                )
+            begin = text.rfind("\n", 0, i) + 1
+            if char == "}" and not text[begin:i].strip():
+                if text[begin:i] != opener_indent:
+                    misindented.append(opener_line)
+            i += 1
+        else:
+            i += 1
+    if stack:
+        # any of them may be the one missing its closer, as may a brace that took the closer
+        # of another, e.g. an added `if (x) {` takes the `}` of its function
+        lines = [opener_line for opener_line in reversed(misindented)]
+        lines += [opener_line for _, opener_line, _ in reversed(stack)]
+        return list(dict.fromkeys(lines)), f"'{stack[-1][0]}' is never closed"
+    return None
+
+
+def _indent(text: str, pos: int) -> str:
+    begin = text.rfind("\n", 0, pos) + 1
+    end = begin
+    while end < len(text) and text[end] in " \t":
+        end += 1
+    return text[begin:end]
+
+
+def syntax_only_command(command: str) -> str:
+    """
+    Turn a recorded compiler command into one that only checks the syntax of its source.
+
+    Dependency file and output options are dropped, as is everything after the first `;`
+    or `&&`, e.g. the objtool run that Kbuild appends to its `.o.cmd` files.
+
+    Args:
+        command (str): The compiler command, e.g. from compile_commands.json.
+
+    Returns:
+        str: The command with `-fsyntax-only` instead of `-c -o file.o`.
+    """
+    args = []
+    words = iter(shlex.split(command))
+    for word in words:
+        if word in (";", "&&", "||"):
+            break
+        if word.endswith(";"):
+            args.append(word[:-1])
+            break
+        if word in ("-o", "-MF", "-MT", "-MQ"):
+            next(words, None)
+        elif word in ("-c", "-MD", "-MMD") or word.startswith(("-Wp,-MD", "-Wp,-MMD")):
+            continue
+        else:
+            args.append(word)
+    return shlex.join(args + ["-fsyntax-only"])
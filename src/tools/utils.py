@@ -1,10 +1,17 @@
+import heapq
 import os
 import re
+import time
 import traceback
-from typing import Generator, List, Tuple
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Generator, List, Tuple
 
 import Levenshtein
+import numpy as np
 
+from tools.cache import lines_cache
+from tools.fuzzy_index import FuzzyIndex
 from tools.logger import logger
 
 blacklist = [
@@ -32,37 +39,48 @@ blacklist = [
 ]
 
 
-def find_most_similar_files(target_filename: str, search_directory: str) -> List[str]:
+@contextmanager
+def timed(stage_times: Dict[str, float], stage: str) -> Generator[None, None, None]:
+    """
+    Add the wall time spent in the with-block to `stage_times[stage]`.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        stage_times[stage] = stage_times.get(stage, 0) + time.time() - start
+
+
+def find_most_similar_files(
+    target_filename: str, file_paths: Dict[str, List[str]], file_index: FuzzyIndex
+) -> List[str]:
     """
     Find the five file paths that are most similar to non-existent files.
 
     Args:
         target_filename (str): The target file's name which we want to find out.
-        search_directory (str): Directory name which we need to find in.
+        file_paths (Dict[str, List[str]]): Tracked file paths of a ref, grouped by file name.
+        file_index (FuzzyIndex): Fuzzy index over the file names of `file_paths`.
 
     Returns:
         List[str]: List of the five most similar file.
     """
     top_n = 5
-    similarity_list = []
-
-    # Walk through all subdirectories and files in the search directory
-    for root, dirs, files in os.walk(search_directory):
-        for filename in files:
-            # Calculate the Levenshtein distance between the target filename and the current filename
-            distance = Levenshtein.distance(target_filename, filename)
-            relative_path = os.path.relpath(
-                os.path.join(root, filename), search_directory
-            )
-            similarity_list.append((distance, relative_path))
-
-    # Sort the list by distance in ascending order and get the top N results
-    similarity_list.sort(key=lambda x: x[0])
-    top_similar_files = [
-        relative_path for distance, relative_path in similarity_list[:top_n]
-    ]
+    similar_names = file_index.search(target_filename, top_n)
+    if sum(len(file_paths[name]) for _, name in similar_names) < top_n:
+        # not enough names within the distance bound, fall back to a heap-based top-k
+        similar_names = heapq.nsmallest(
+            top_n,
+            (
+                (Levenshtein.distance(target_filename, name), name)
+                for name in file_paths
+            ),
+        )
 
-    return top_similar_files
+    top_similar_files = []
+    for _, name in similar_names:
+        top_similar_files.extend(file_paths[name])
+    return top_similar_files[:top_n]
 
 
 def find_most_similar_block(
@@ -83,14 +101,51 @@ def find_most_similar_block(
     """
     min_distance = float("inf")
     best_start_index = 1
+    pattern_text = "\n".join(pattern)
+    num_windows = len(main) - p_len + 1
+
+    def skipped(i: int) -> bool:
+        return (
+            dline_flag
+            and i < len(main)
+            and (main[i].startswith("+") or main[i].startswith("-"))
+        )
+
+    # Lines unique in both the pattern and main anchor candidate windows, like patience diff.
+    # The best anchored window bounds the distance, so the scan below only computes distances
+    # up to that bound and skips windows whose length alone exceeds it.
+    bound = float("inf")
+    main_count = Counter(main)
+    pattern_count = Counter(pattern)
+    main_index = {line: i for i, line in enumerate(main) if main_count[line] == 1}
+    for j, line in enumerate(pattern):
+        if pattern_count[line] == 1 and line in main_index:
+            start = main_index[line] - j
+            if 0 <= start < num_windows and not skipped(start):
+                bound = min(
+                    bound,
+                    Levenshtein.distance(
+                        "\n".join(main[start : start + p_len]), pattern_text
+                    ),
+                )
 
-    for i in range(len(main) - p_len + 1):
+    # length of "\n".join(main[i : i + p_len]) is offsets[i + p_len] - offsets[i] - 1
+    offsets = [0]
+    for line in main:
+        offsets.append(offsets[-1] + len(line) + 1)
+    for i in range(num_windows):
+        if skipped(i):
+            continue
+        cutoff = min(bound, min_distance)
+        window_len = max(offsets[i + p_len] - offsets[i] - 1, 0)
+        if abs(window_len - len(pattern_text)) > cutoff:
+            continue
         distance = Levenshtein.distance(
-            "\n".join(main[i : i + p_len]), "\n".join(pattern)
+            "\n".join(main[i : i + p_len]),
+            pattern_text,
+            score_cutoff=None if cutoff == float("inf") else cutoff,
         )
-        if distance < min_distance and not (
-            dline_flag and (main[i].startswith("+") or main[i].startswith("-"))
-        ):
+        if distance < min_distance:
             min_distance = distance
             best_start_index = i + 1
 
@@ -117,6 +172,77 @@ def find_most_similar_block(
     return best_start_index, min_distance
 
 
+def find_most_similar_block_in_files(
+    pattern: List[str], files: Dict[str, List[str]], p_len: int, top_n: int = 8
+) -> Tuple[str | None, int, int]:
+    """
+    Finds the most similar block of lines across several files at once.
+    Lines are hashed into integer arrays and every window of every file is scored by how many of its lines
+    also appear in the pattern. Only the `top_n` best scored windows are refined with `find_most_similar_block`.
+
+    Args:
+        pattern (List[str]): The list of code lines to match.
+        files (Dict[str, List[str]]): The lines of each candidate file, keyed by file path.
+        p_len (int): The length of the pattern.
+        top_n (int, optional): The number of windows refined with exact edit distance. Defaults to 8.
+
+    Returns:
+        Tuple[str | None, int, int]: The file path of the most similar block (None if no file is long enough),
+                                     its starting index (1-based index) and the minimum Levenshtein distance.
+    """
+    paths = [path for path, lines in files.items() if len(lines) >= max(p_len, 1)]
+    if not paths:
+        return None, -1, float("inf")
+
+    pattern_hashes = np.unique(
+        np.fromiter((hash(line.strip()) for line in pattern), dtype=np.int64)
+    )
+    # windows are scored over the concatenation of all files, starts crossing a file end are masked out
+    hashes = np.concatenate(
+        [
+            np.fromiter(
+                (hash(line.strip()) for line in files[path]),
+                dtype=np.int64,
+                count=len(files[path]),
+            )
+            for path in paths
+        ]
+    )
+    file_ids = np.repeat(np.arange(len(paths)), [len(files[path]) for path in paths])
+    file_starts = np.cumsum([0] + [len(files[path]) for path in paths])[:-1]
+    matched = np.concatenate(([0], np.cumsum(np.isin(hashes, pattern_hashes))))
+    # an empty pattern, e.g. of a pure addition, still gets one window per line
+    num_windows = len(hashes) - max(p_len, 1) + 1
+    scores = matched[p_len : p_len + num_windows] - matched[:num_windows]
+    window_end = np.arange(num_windows) + max(p_len, 1) - 1
+    scores = np.where(file_ids[:num_windows] == file_ids[window_end], scores, -1)
+
+    # refine the best windows which do not overlap each other
+    candidates = []
+    for start in np.argsort(-scores, kind="stable"):
+        if scores[start] < 0 or len(candidates) >= top_n:
+            break
+        if all(
+            file_ids[start] != file_ids[other] or abs(int(start) - int(other)) >= p_len
+            for other in candidates
+        ):
+            candidates.append(start)
+
+    best_path, best_lineno, min_distance = None, -1, float("inf")
+    for start in sorted(candidates):
+        path = paths[file_ids[start]]
+        lines = files[path]
+        start = int(start - file_starts[file_ids[start]])
+        low = max(start - p_len, 0)
+        high = min(start + 2 * p_len, len(lines))
+        lineno, distance = find_most_similar_block(
+            pattern, lines[low:high], p_len, False
+        )
+        if distance < min_distance:
+            best_path, best_lineno, min_distance = path, low + lineno, distance
+    return best_path, best_lineno, min_distance
+
+
 def extract_context(lines: list) -> Tuple[list, int, list, int]:
     """
     Process the input string by removing certain lines and returning the processed string and the count of processed lines.
@@ -142,8 +268,33 @@ def extract_context(lines: list) -> Tuple[list, int, list, int]:
     return processed_lines, processed_lines_count, add_lines, len(add_lines)
 
 
+def read_file_lines(file_path: str) -> List[str]:
+    """
+    Read the lines of a file in the working tree through the shared LRU cache.
+    The cache key contains the mtime and size of the file, so rewritten files are read again.
+
+    Args:
+        file_path (str): Path of the file.
+
+    Returns:
+        List[str]: Lines of the file, which must not be modified.
+    """
+    stat = os.stat(file_path)
+    key = ("file", os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+
+    def load() -> List[str]:
+        with open(file_path, "rb") as f:
+            content = f.read().decode("utf-8", errors="ignore")
+        return [line.rstrip("\n") for line in content.splitlines()]
+
+    return lines_cache.get(key, load)
+
+
 def revise_patch(
-    patch: str, project_path: str, revise_context: bool = False
+    patch: str,
+    project_path: str,
+    revise_context: bool = False,
+    file_reader: Callable[[str], List[str]] | None = None,
 ) -> Tuple[str, bool]:
     """fix mistakes in generated patch.
     1. wrong line numbers.
@@ -154,6 +305,8 @@ def revise_patch(
         patch (str): patch to be revised.
         project_path (str): CVE project source code in local.
         revise_context (bool, optional): True means force to revise all context lines. Defaults to False.
+        file_reader (Callable[[str], List[str]] | None, optional): Reads the lines of a file by its relative path instead of
+            reading the working tree at `project_path`, e.g. from a git ref. Defaults to None.
 
     Returns:
         Tuple[str, bool]: revised patch and fix flag.
@@ -259,9 +412,10 @@ def revise_patch(
             f"+++ b/{fixed_file_path_b}".replace("b/--- ", ""),
         ]
         try:
-            with open(os.path.join(project_path, file_path_a), "rb") as f:
-                content = f.read().decode("utf-8", errors="ignore")
-                file_content = [line.rstrip("\n") for line in content.splitlines()]
+            if file_reader:
+                file_content = file_reader(file_path_a)
+            else:
+                file_content = read_file_lines(os.path.join(project_path, file_path_a))
         except:
             # do not revise patch if file changed, handle changed file in `_apply_hunk`
             return lines, False
@@ -311,6 +465,97 @@ def revise_patch(
         return patch, False
 
 
+def group_dependent_hunks(hunks: List[str]) -> List[List[int]]:
+    """
+    Group hunks that touch overlapping or adjacent lines of the same file. Hunks of
+    different groups are independent and can be backported concurrently.
+
+    Args:
+        hunks (List[str]): Hunks yielded by `split_patch`.
+
+    Returns:
+        List[List[int]]: Indexes of the hunks in each group, in their original order.
+    """
+    ranges = {}
+    for idx, hunk in enumerate(hunks):
+        path = re.findall(r"--- a/(.*)", hunk)
+        chunks = re.findall(r"@@ -(\d+)(?:,(\d+))?", hunk)
+        if not path or not chunks:
+            # can not tell where it applies, such hunks are serialized with each other
+            ranges.setdefault(None, []).append((0, float("inf"), idx))
+            continue
+        start, length = int(chunks[0][0]), int(chunks[0][1] or 1)
+        ranges.setdefault(path[0], []).append((start, start + length, idx))
+
+    groups = []
+    for file_ranges in ranges.values():
+        file_ranges.sort()
+        end = -1
+        for start, stop, idx in file_ranges:
+            if start > end:
+                groups.append([])
+            groups[-1].append(idx)
+            end = max(end, stop)
+    for group in groups:
+        group.sort()
+    groups.sort()
+    return groups
+
+
+def patched_files(patch: str) -> List[str]:
+    """
+    The files a patch changes, relative to the repository root, in the order they appear.
+    """
+    return list(dict.fromkeys(re.findall(r"^\+\+\+ b/(\S+)", patch, re.M)))
+
+
+def map_patch_lines(patch: str, path: str, file_lines: List[str]) -> Dict[int, int]:
+    """
+    Map the lines of a patched file that come from a patch to their line numbers in the patch.
+
+    `git apply` tolerates hunks whose header is off by a few lines, so each hunk is placed
+    where its context and added lines actually are in the patched file, the closest match
+    to its header wins.
+
+    Args:
+        patch (str): The applied patch.
+        path (str): The file, relative to the repository root.
+        file_lines (List[str]): The lines of the patched file.
+
+    Returns:
+        Dict[int, int]: Line numbers in the patched file to line numbers in the patch.
+    """
+    hunks = []
+    current = None
+    for number, text in enumerate(patch.splitlines(), 1):
+        if text.startswith("+++ "):
+            current = text[6:] if text.startswith("+++ b/") else None
+            continue
+        if current != path:
+            continue
+        header = re.match(r"@@ -\d+(?:,\d+)? \+(\d+)", text)
+        if header:
+            hunks.append((int(header[1]), []))
+        elif hunks and not text.startswith(("-", "\\")):
+            hunks[-1][1].append((number, text[1:]))
+
+    file_lines = [text.rstrip() for text in file_lines]
+    mapping = {}
+    for start, new_lines in hunks:
+        texts = [text.rstrip() for _, text in new_lines]
+        positions = [
+            pos
+            for pos in range(len(file_lines) - len(texts) + 1)
+            if not texts
+            or file_lines[pos] == texts[0]
+            and file_lines[pos : pos + len(texts)] == texts
+        ]
+        pos = min(positions, key=lambda pos: abs(pos + 1 - start), default=start - 1)
+        for offset, (number, _) in enumerate(new_lines, 1):
+            mapping.setdefault(pos + offset, number)
+    return mapping
+
+
 def split_patch(patch: str, flag_commit: bool) -> Generator[str, None, None]:
     """
     Split a patch into individual blocks.
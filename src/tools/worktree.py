@@ -0,0 +1,128 @@
+import fcntl
+import os
+import shutil
+from contextlib import contextmanager
+
+from git import Repo
+
+from tools.logger import logger
+
+
+class WorktreePool:
+    """
+    Pool of `git worktree` checkouts of one repository, one per commit, created lazily and
+    reused across hunks and jobs.
+
+    A worktree is guarded by a file lock while a job uses it, so jobs in different processes
+    can share one clone safely. Beyond `max_worktrees`, the least recently used worktrees
+    that are not locked are removed, together with their build directories under
+    `build_root`.
+    """
+
+    def __init__(
+        self,
+        repo: Repo,
+        pool_dir: str,
+        max_worktrees: int = 4,
+        build_root: str | None = None,
+    ):
+        self.repo = repo
+        self.pool_dir = pool_dir
+        self.max_worktrees = max_worktrees
+        self.build_root = build_root
+        self.locks = {}
+        os.makedirs(pool_dir, exist_ok=True)
+
+    @contextmanager
+    def _pool_lock(self):
+        with open(os.path.join(self.pool_dir, ".pool.lock"), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def acquire(self, sha: str) -> str:
+        """
+        Lock the worktree of a commit for this process, creating it if needed.
+
+        Args:
+            sha (str): The resolved commit SHA.
+
+        Returns:
+            str: Path of the worktree.
+        """
+        path = os.path.join(self.pool_dir, sha)
+        if sha in self.locks:
+            return path
+
+        while True:
+            lock = open(f"{path}.lock", "a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug(f"Waiting for worktree {path} used by another job.")
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # eviction may have removed the lock file while we were waiting for it
+            try:
+                if os.fstat(lock.fileno()).st_ino == os.stat(lock.name).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            lock.close()
+        self.locks[sha] = lock
+        os.utime(lock.name)
+
+        with self._pool_lock():
+            if not os.path.exists(os.path.join(path, ".git")):
+                logger.debug(f"Creating worktree {path}.")
+                self.repo.git.worktree("prune")
+                self.repo.git.worktree("add", "--detach", "--force", path, sha)
+            self._evict()
+        return path
+
+    def release(self, sha: str) -> None:
+        if lock := self.locks.pop(sha, None):
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def release_all(self) -> None:
+        for sha in list(self.locks):
+            self.release(sha)
+
+    def _remove_build_dir(self, name: str) -> None:
+        if self.build_root is not None:
+            shutil.rmtree(os.path.join(self.build_root, name), ignore_errors=True)
+
+    def _evict(self) -> None:
+        if self.build_root is not None and os.path.isdir(self.build_root):
+            # build directories whose worktree is gone, e.g. evicted by an older version
+            for name in os.listdir(self.build_root):
+                if not os.path.isdir(os.path.join(self.pool_dir, name)):
+                    self._remove_build_dir(name)
+
+        worktrees = [
+            os.path.join(self.pool_dir, name)
+            for name in os.listdir(self.pool_dir)
+            if os.path.isdir(os.path.join(self.pool_dir, name))
+        ]
+        if len(worktrees) <= self.max_worktrees:
+            return
+        worktrees.sort(
+            key=lambda path: (
+                os.path.getmtime(f"{path}.lock")
+                if os.path.exists(f"{path}.lock")
+                else 0
+            )
+        )
+        for path in worktrees[: len(worktrees) - self.max_worktrees]:
+            with open(f"{path}.lock", "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                logger.debug(f"Removing least recently used worktree {path}.")
+                self.repo.git.worktree("remove", "--force", path)
+                self._remove_build_dir(os.path.basename(path))
+                os.remove(lock.name)
+                fcntl.flock(lock, fcntl.LOCK_UN)
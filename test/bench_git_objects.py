@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+import time
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+src_dir_path = os.path.join(parent_dir, "src")
+sys.path.append(src_dir_path)
+
+from git import Repo
+
+from tools.git_objects import GitObjectReader
+
+
+def bench(name: str, func, paths: list, number: int) -> float:
+    start = time.perf_counter()
+    for i in range(number):
+        func(paths[i % len(paths)])
+    rate = number / (time.perf_counter() - start)
+    print(f"{name:<40}{rate:>10.0f} calls/s")
+    return rate
+
+
+def main():
+    """
+    Compare object lookups through GitPython and `git` subprocesses with the persistent `git cat-file` reader.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark git object access",
+        usage="%(prog)s --repo REPO [--ref REF] [--number N]",
+    )
+    parser.add_argument("-r", "--repo", type=str, default=".", help="git repository")
+    parser.add_argument("--ref", type=str, default="HEAD", help="commit to read")
+    parser.add_argument("-n", "--number", type=int, default=500, help="calls per case")
+    args = parser.parse_args()
+
+    repo = Repo(args.repo)
+    reader = GitObjectReader(args.repo)
+    sha = repo.commit(args.ref).hexsha
+    paths = [item.path for item in repo.tree(sha).traverse() if item.type == "blob"]
+    paths = paths[:200]
+    print(f"{len(paths)} files of {sha} in {args.repo}, {args.number} calls per case")
+
+    print("resolve ref")
+    before = bench(
+        "  GitPython repo.commit",
+        lambda _: repo.commit(args.ref).hexsha,
+        paths,
+        args.number,
+    )
+    after = bench(
+        "  cat-file --batch-check",
+        lambda _: reader.resolve(args.ref),
+        paths,
+        args.number,
+    )
+    print(f"  speedup {after / before:.1f}x")
+
+    print("read blob by path")
+    before = bench(
+        "  git show ref:path",
+        lambda path: repo.git.show(f"{sha}:{path}"),
+        paths,
+        args.number,
+    )
+    bench(
+        "  GitPython tree / path",
+        lambda path: (repo.tree(sha) / path).data_stream.read(),
+        paths,
+        args.number,
+    )
+    after = bench(
+        "  cat-file --batch",
+        lambda path: reader.read(f"{sha}:{path}"),
+        paths,
+        args.number,
+    )
+    print(f"  speedup over git show {after / before:.1f}x")
+
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ import argparse
 import logging
 import os
 import sys
-import shutil
 
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 src_dir_path = os.path.join(parent_dir, "src")
@@ -37,16 +36,13 @@ def main():
 
     # Initialize: load config, create project and get sh file in dataset
     data = load_yml(config_file)
-    for file in os.listdir(data.patch_dataset_dir):
-        if os.path.exists(f"{data.project_dir}{file}"):
-            os.remove(f"{data.project_dir}{file}")
-        shutil.copy2(f"{data.patch_dataset_dir}{file}", f"{data.project_dir}{file}")
     project = Project(data)
 
     # HACK: call func to test patch here, for example, I call `_validate`
     revised_patch, _ = revise_patch(patch, project.dir)
     project.all_hunks_applied_succeeded = True
     project._validate(data.target_release, revised_patch)
+    project.close()
     if project.poc_succeeded:
         logger.info(
             f"Patch successfully passes validation on target release {data.target_release}"